@@ -3,6 +3,8 @@
 bot_token = "TOKEN"
 # tenor API key https://developers.google.com/tenor/guides/quickstart#setup
 tenor_key = "CHAVE"
+# url base da API v2 do tenor. só mude para testar contra um servidor local
+tenor_api_url = "https://tenor.googleapis.com/v2"
 # BotBlock tokens. see https://pypi.org/project/discordlists.py/
 bot_list_data = None
 # bot_list_data = {
@@ -12,6 +14,8 @@ bot_list_data = None
 # }
 # número de comandos que podem ser processados ​​ao mesmo tempo. definido como Nenhum para usar automaticamente a contagem de núcleos da CPU do SO
 workers = None
+# quantas tarefas cada processo worker executa antes de ser substituído por um novo
+worker_max_tasks = 100
 # especifique manualmente tempdir em vez de usar o padrão do sistema operacional
 # temp dir padrão para /dev/shm (na memória) se disponível e esta variável é None
 override_temp_dir = None
@@ -60,8 +64,18 @@ file_upload_limit = 8_388_119
 # falhou. isso tem como objetivo bloquear linguagem odiosa como calúnias. não diferencia maiúsculas de minúsculas.
 # está na configuração, então não preciso enviar calúnias para o github...
 blocked_words = []
-# nome do arquivo do banco de dados sqlite3. atualmente usado apenas para armazenar prefixos específicos do servidor.
+# nome do arquivo do banco de dados sqlite3. usado para prefixos específicos do servidor, banimentos e caches.
 db_filename = "database.db"
+# número máximo de sondagens de mídia (tipo, resolução, fps, duração, codecs) guardadas no banco de dados.
+# as menos usadas recentemente são removidas primeiro.
+probe_cache_rows = 10_000
+# tamanho máximo, em bytes, do cache de resultados de comandos (guardado ao lado do temp dir). 0 para desativar.
+result_cache_size = 500_000_000
+# tamanho máximo, em bytes, do cache de arquivos baixados, para que edições encadeadas no mesmo anexo não baixem de novo.
+# 0 para desativar.
+download_cache_size = 250_000_000
+# tamanho máximo, em bytes, do cache de legendas renderizadas (guardado ao lado do temp dir). 0 para desativar.
+render_cache_size = 100_000_000
 # default prefix for commands
 default_command_prefix = "ez!"
 # este url receberá uma solicitação periódica. isso é projetado para ser usado com um serviço de monitoramento de tempo de atividade
@@ -75,5 +89,16 @@ shard_count = None
 max_frames = 1024
 # tamanho máximo de arquivo temporário do FFmpeg. reduza se o ffmpeg consumir muito seu disco/memória, aumente se puder
 max_temp_file_size = "1G"
+# codec sem perdas dos arquivos intermediários entre etapas do ffmpeg: "ffv1", "utvideo", "qtrle", "rawvideo" ou "png".
+# todos preservam transparência. rode src/benchmarks/intermediate.py para comparar no seu servidor
+intermediate_codec = "png"
 # limite FPS para sanidade
 max_fps = 100
+# como os vídeos são comprimidos para caber no limite de upload: "vbv" (uma passagem, mais rápido), "twopass" (duas
+# passagens, mais preciso) ou "auto" para usar o vbv enquanto ele acertar o tamanho em pelo menos 90% dos vídeos
+capvideo_mode = "auto"
+# divide a fila de forma justa entre servidores e, dentro deles, entre usuários, para que ninguém lote a fila.
+# False para a ordem de chegada. rode src/benchmarks/fairqueue.py para comparar
+fair_queue = True
+# com que frequência (em segundos) gravar no banco de dados os tempos de execução dos comandos, usados para o ETA da fila
+runtime_stats_flush = 300
@@ -0,0 +1,69 @@
+"""
+teste de carga do v2queue: um usuário lota a fila com tarefas pesadas enquanto usuários leves (em outras guilds e na
+mesma guild) mandam tarefas pequenas. compara a espera dos usuários leves com a fila em ordem de chegada e com
+fair_order(), com e sem a inundação. as tarefas só dormem pelo tempo proporcional ao custo, sem mídia de verdade.
+
+uso, na raiz do repositório (onde está o config.py): python src/benchmarks/fairqueue.py [tarefas pesadas]
+"""
+import asyncio
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.getcwd())
+
+from core import v2queue
+
+# segundos de execução por worker de custo
+unit = .02
+light_users = 20
+light_jobs = 10
+
+
+async def job(waits: list | None, cost: float, guild, user):
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    async with v2queue.slot(cost, guild, user):
+        if waits is not None:
+            waits.append(loop.time() - start)
+        await asyncio.sleep(cost * unit)
+
+
+async def light_user(waits: list, guild, user, rng: random.Random):
+    for _ in range(light_jobs):
+        await asyncio.sleep(rng.expovariate(1 / (unit * 10)))
+        await job(waits, v2queue.min_cost, guild, user)
+
+
+async def scenario(flood: int):
+    rng = random.Random(0)
+    other_guilds, same_guild = [], []
+    tasks = [asyncio.create_task(job(None, rng.uniform(1, v2queue.budget), 1, 1)) for _ in range(flood)]
+    # um quarto dos usuários leves está na mesma guild de quem inunda
+    for i in range(light_users):
+        if i % 4:
+            tasks.append(asyncio.create_task(light_user(other_guilds, 100 + i, 100 + i, rng)))
+        else:
+            tasks.append(asyncio.create_task(light_user(same_guild, 1, 100 + i, rng)))
+    await asyncio.gather(*tasks)
+    return other_guilds, same_guild
+
+
+def p95(waits: list[float]) -> float:
+    return statistics.quantiles(waits, n=20)[-1]
+
+
+def main(flood):
+    print(f"budget {v2queue.budget} workers, {flood} tarefas pesadas, {light_users} usuários leves × {light_jobs}")
+    for fair in [False, True]:
+        v2queue.fair = fair
+        for n in [0, flood]:
+            other_guilds, same_guild = asyncio.run(scenario(n))
+            print(f"{'justa' if fair else 'chegada':>8}, {n:>4} pesadas: p95 da espera leve "
+                  f"{p95(other_guilds) * 1000:7.1f}ms (outras guilds) {p95(same_guild) * 1000:7.1f}ms (mesma guild)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
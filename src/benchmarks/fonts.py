@@ -0,0 +1,58 @@
+"""
+mede quanto o registro único das fontes (processing.common.register_fonts) economiza por legenda, comparando com o
+padrão antigo de renderizar um "." com fontfile=twemoji e passar fontfile= em toda chamada.
+
+uso, na raiz do repositório (onde está o config.py): python src/benchmarks/fonts.py [repetições]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.getcwd())
+
+import pyvips
+
+import processing.common
+
+twemoji = "rendering/fonts/TwemojiCOLR0.otf"
+text = "benchmark caption 👍 with a few more words"
+# (fonte, fontfile) das legendas mais usadas
+cases = [
+    ("FuturaExtraBlackCondensed", "rendering/fonts/caption.otf"),
+    ("ImpactMix", "rendering/fonts/ImpactMix.ttf"),
+    ("Upright", "rendering/fonts/whisper.otf"),
+]
+
+
+def per_call(font, fontfile):
+    pyvips.Image.text(".", fontfile=twemoji)
+    return pyvips.Image.text(text, font=f"Twemoji Color Emoji,{font} 60px", fontfile=fontfile, rgba=True,
+                             width=760).avg()
+
+
+def registered(font, _):
+    return pyvips.Image.text(text, font=f"Twemoji Color Emoji,{font} 60px", rgba=True, width=760).avg()
+
+
+def bench(func, repetitions):
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        for font, fontfile in cases:
+            func(font, fontfile)
+    return (time.perf_counter() - start) / (repetitions * len(cases))
+
+
+def main(repetitions):
+    pyvips.cache_set_max(0)  # sem o cache de operações do libvips, senão só a primeira chamada renderiza
+    start = time.perf_counter()
+    processing.common.register_fonts()
+    print(f"register_fonts(): {(time.perf_counter() - start) * 1000:.1f}ms, uma vez por worker")
+    old = bench(per_call, repetitions)
+    new = bench(registered, repetitions)
+    print(f"fontfile= por chamada: {old * 1000:.2f}ms/legenda")
+    print(f"  fontes registradas: {new * 1000:.2f}ms/legenda ({(old - new) * 1000:.2f}ms economizados)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -0,0 +1,60 @@
+"""
+compara os codecs de processing.ffmpeg.intermediate_codecs: tempo de codificação + decodificação e tamanho no temp dir
+(/dev/shm normalmente), com um clipe de teste com transparência e áudio. use para escolher config.intermediate_codec.
+
+uso, na raiz do repositório (onde está o config.py): python src/benchmarks/intermediate.py [segundos] [resolução]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.getcwd())
+
+import processing.ffmpeg
+import utils.tempfiles
+from processing.common import run_command
+from processing.ffprobe import probe
+
+
+async def timed(*args):
+    start = time.perf_counter()
+    await run_command(*args)
+    return time.perf_counter() - start
+
+
+async def bench(duration, resolution):
+    async with utils.tempfiles.TempFileSession():
+        # fundo em movimento com alfa variando, parecido com uma legenda sobre um gif
+        source = utils.tempfiles.reserve_tempfile("nut")
+        await run_command("ffmpeg", "-f", "lavfi", "-i",
+                          f"testsrc2=size={resolution}:rate=30:duration={duration},format=rgba,"
+                          f"geq=r='r(X,Y)':g='g(X,Y)':b='b(X,Y)':a='if(gt(Y,H/3),255,128+127*sin(T+X/40))'",
+                          "-f", "lavfi", "-i", f"sine=duration={duration}", "-c:v", "rawvideo", "-c:a", "pcm_s16le",
+                          source)
+        results = []
+        for name, (ext, args) in processing.ffmpeg.intermediate_codecs.items():
+            out = utils.tempfiles.reserve_tempfile(ext)
+            encode = await timed("ffmpeg", "-i", source, *args, "-fps_mode", "vfr", out)
+            decode = await timed("ffmpeg", "-i", out, "-f", "null", "-")
+            pix_fmt = (await probe(out)).streams[0].get("pix_fmt", "?")
+            results.append((name, encode, decode, os.path.getsize(out), pix_fmt))
+        return results
+
+
+def main(duration, resolution):
+    os.makedirs(utils.tempfiles.temp_dir, exist_ok=True)
+    results = asyncio.run(bench(duration, resolution))
+    png_size = next(size for name, _, _, size, _ in results if name == "png")
+    print(f"{duration}s {resolution} @ 30fps em {utils.tempfiles.temp_dir}")
+    for name, encode, decode, size, pix_fmt in sorted(results, key=lambda r: r[1] + r[2]):
+        print(f"{name:>9}: codificar {encode:.2f}s decodificar {decode:.2f}s "
+              f"tamanho {size / 1e6:.1f}MB ({size / png_size:.1f}x png) {pix_fmt}")
+    # o mais rápido que não ocupa muito mais memória que o png
+    best = min((r for r in results if r[3] <= png_size * 2), key=lambda r: r[1] + r[2])
+    print(f"recomendado: intermediate_codec = \"{best[0]}\"")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5, sys.argv[2] if len(sys.argv) > 2 else "640x480")
@@ -0,0 +1,64 @@
+"""
+compara os dois modos de run_parallel() (pool de threads vs pool de processos) nas funções de legenda do libvips.
+
+uso, na raiz do repositório (onde está o config.py): python src/benchmarks/run_parallel.py [repetições]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.getcwd())
+
+import psutil
+
+import processing.common
+import processing.vips.caption
+import processing.vips.creation
+import utils.tempfiles
+from core import v2queue
+from processing.vips.vipsutils import ImageSize
+
+size = ImageSize(800, 600)
+cases = [
+    (processing.vips.caption.esmcaption, (["benchmark caption 👍 with a few more words"], size)),
+    (processing.vips.caption.mediaforge_caption, (["benchmark caption 👍 with a few more words"], size)),
+    (processing.vips.caption.motivate_text, (["top text", "bottom text"], size)),
+    (processing.vips.caption.meme, (["top text", "bottom text"], size)),
+    (processing.vips.caption.whisper, (["whisper 👍"], size)),
+    (processing.vips.caption.twitter_text, (["twitter text 👍"], size, True)),
+    (processing.vips.creation.yskysn, (["you should kill", "yourself now"],)),
+]
+
+
+def rss():
+    # (bot, workers), o modo de threads cresce o primeiro e o de processos o segundo
+    me = psutil.Process()
+    return me.memory_info().rss, sum(c.memory_info().rss for c in me.children(recursive=True))
+
+
+async def bench(run, repetitions):
+    async with utils.tempfiles.TempFileSession():
+        # uma rodada de aquecimento para não medir a inicialização dos workers
+        await asyncio.gather(*[run(func, *args) for func, args in cases])
+        start = time.perf_counter()
+        await asyncio.gather(*[run(func, *args) for func, args in cases for _ in range(repetitions)])
+        return time.perf_counter() - start, rss()
+
+
+async def main(repetitions):
+    os.makedirs(utils.tempfiles.temp_dir, exist_ok=True)
+    await processing.common.init_pool()
+    total = len(cases) * repetitions
+    print(f"{total} renders, {v2queue.workers} workers")
+    for name, run in [("thread", processing.common.run_in_thread), ("process", processing.common.run_in_process)]:
+        # tarefa própria para ter um contexto novo, uma TempFileSession por contexto
+        elapsed, (main_rss, workers_rss) = await asyncio.create_task(bench(run, repetitions))
+        print(f"{name:>8}: {elapsed:.2f}s ({elapsed / total * 1000:.1f}ms/render), "
+              f"rss bot {main_rss / 1e6:.0f}MB workers {workers_rss / 1e6:.0f}MB")
+    processing.common.shutdown_executors()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10))
@@ -3,6 +3,7 @@ from discord.ext import commands
 
 from core.clogs import logger
 from utils.common import prefix_function
+from utils.scandiscord import recent_media
 
 
 class BotEventsCog(commands.Cog):
@@ -22,10 +23,12 @@ class BotEventsCog(commands.Cog):
     @commands.Cog.listener()
     async def on_disconnect(self):
         logger.error("on_disconnect")
+        recent_media.clear()
 
     @commands.Cog.listener()
     async def on_shard_disconnect(self, shardid):
         logger.error(f"Shard {shardid} Desconectado")
+        recent_media.clear()
 
     @commands.Cog.listener()
     async def on_command(self, ctx: commands.Context):
@@ -46,6 +49,8 @@ class BotEventsCog(commands.Cog):
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
+        # the bot's own results count as media too
+        recent_media.add(message)
         if message.author == self.bot.user:
             return
         if message.content.strip() in [f"<@{self.bot.user.id}>", f"<@!{self.bot.user.id}>"]:
@@ -54,6 +59,14 @@ class BotEventsCog(commands.Cog):
                                 f"me mencionar! Execute `{pfx}ajuda` para obter ajuda do bot.", delete_after=10,
                                 mention_author=False)
 
+    @commands.Cog.listener()
+    async def on_message_edit(self, before: discord.Message, after: discord.Message):
+        recent_media.edit(after)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        recent_media.delete(payload.channel_id, payload.message_id)
+
     @commands.Cog.listener()
     async def on_command_completion(self, ctx):
         if ctx.interaction:
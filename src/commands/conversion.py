@@ -15,7 +15,7 @@ import utils.discordmisc
 import utils.web
 from core.clogs import logger
 from core.process import process
-from processing.common import run_parallel
+from processing.common import run_io
 from processing.other import ytdownload
 from utils.common import prefix_function
 from utils.dpy import UnicodeEmojisConverter
@@ -99,7 +99,7 @@ class Conversion(commands.Cog, name="Conversão"):
         msg = await ctx.reply(f"{config.emojis['working']} Baixando do site...", mention_author=False)
         try:
             async with utils.tempfiles.TempFileSession():
-                r = await run_parallel(ytdownload, videourl, videoformat)
+                r = await run_io(ytdownload, videourl, videoformat)
                 if r:
                     r = await processing.ffmpeg.assurefilesize(r, re_encode=False)
                     if not r:
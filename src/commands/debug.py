@@ -5,22 +5,32 @@ import os
 import typing
 
 import discord
+import humanize
 from discord import app_commands
 from discord.ext import commands
 
 import config
 import processing.common
+import processing.ffprobe
 import processing.other
+import processing.vips.vipsutils
 import utils.tempfiles
-from core import database, heartbeat
+import utils.web
+from core import database, heartbeat, resultcache
 from core.clogs import logger
 # from main import renderpool, bot, database.db, quote
-from utils.common import fetch, quote
+from utils.common import fetch, quote, http_stats
+from utils.diskcache import DiskCache
 from utils.dpy import showcog
 from utils.scandiscord import imagesearch
 from utils.web import saveurls
 
 
+def describe_cache(cache: DiskCache):
+    return f"{cache.stats['hits']} hits, {cache.stats['misses']} misses, {len(cache.index)} files, " \
+           f"{humanize.naturalsize(cache.total_bytes)} / {humanize.naturalsize(cache.max_bytes)}."
+
+
 class Debug(commands.Cog, name="Somente Proprietário", command_attrs=dict(hidden=True)):
     def __init__(self, bot):
         self.bot: commands.Bot = bot
@@ -186,3 +196,49 @@ class Debug(commands.Cog, name="Somente Proprietário", command_attrs=dict(hidde
     @commands.is_owner()
     async def sendfile(self, ctx, path):
         await ctx.reply(file=discord.File(path))
+
+    @commands.command()
+    @commands.is_owner()
+    async def probecache(self, ctx):
+        """
+        Show hit/miss counters of the persistent probe cache
+        """
+        async with database.db.execute("SELECT count(*) from probe_cache") as cur:
+            rows = (await cur.fetchone())[0]
+        stats = processing.ffprobe.probe_cache_stats
+        total = stats["hits"] + stats["misses"]
+        ratio = f"{stats['hits'] / total:.1%}" if total else "n/a"
+        await ctx.reply(f"Probe cache: {stats['hits']} hits, {stats['misses']} misses ({ratio} hit rate), "
+                        f"{rows} rows stored.")
+
+    @commands.command()
+    @commands.is_owner()
+    async def resultcache(self, ctx):
+        """
+        Show hit/miss counters and size of the command result cache
+        """
+        await ctx.reply(f"Result cache: {describe_cache(resultcache.cache)}")
+
+    @commands.command()
+    @commands.is_owner()
+    async def downloadcache(self, ctx):
+        """
+        Show hit/miss counters and size of the URL download cache
+        """
+        await ctx.reply(f"Download cache: {describe_cache(utils.web.downloads)}")
+
+    @commands.command()
+    @commands.is_owner()
+    async def httpstats(self, ctx):
+        """
+        Show connection reuse stats of the shared HTTP session
+        """
+        await ctx.reply("\n".join(f"{k}: {v}" for k, v in http_stats.items()))
+
+    @commands.command()
+    @commands.is_owner()
+    async def rendercache(self, ctx):
+        """
+        Show hit/miss counters and size of the caption render cache
+        """
+        await ctx.reply(f"Render cache: {describe_cache(processing.vips.vipsutils.render_cache)}")
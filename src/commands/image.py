@@ -136,4 +136,4 @@ class Image(commands.Cog, name="Criação"):
         :param ctx: discord context
         :param text: The text to cut and splice.
         """
-        await process(ctx, sus.sus, [], text, run_parallel=True)
+        await process(ctx, sus.sus, [], text, run_parallel=True, cache=False)
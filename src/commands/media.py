@@ -5,6 +5,7 @@ from discord import app_commands
 from discord.ext import commands
 
 import config
+import processing.chain
 import processing.ffmpeg
 from core.process import process
 from utils.common import prefix_function
@@ -67,7 +68,8 @@ class Media(commands.Cog, name="Edição"):
         :param quality: qualidade da compressão JPEG. deve estar entre 1 e 95.
         :mediaparam media: Uma imagem.
         """
-        await process(ctx, processing.vips.other.jpeg, [["IMAGE"]], strength, stretch, quality, run_parallel=True)
+        await process(ctx, processing.vips.other.jpeg, [["IMAGE"]], strength, stretch, quality, run_parallel=True,
+                      cache=stretch == 0)
 
     @commands.hybrid_command()
     async def deepfry(self, ctx, brightness: commands.Range[float, -1, 1] = 0.5,
@@ -364,6 +366,22 @@ class Media(commands.Cog, name="Edição"):
         """
         await process(ctx, processing.ffmpeg.speed, [["VIDEO", "GIF", "AUDIO"]], speed)
 
+    @commands.hybrid_command(aliases=["pipe", "then"])
+    async def chain(self, ctx, *, steps: str):
+        """
+        Executa vários comandos de edição em sequência na mesma mídia e envia só o resultado final.
+        Separe os comandos com `|`, por exemplo `chain hue 90 | speed 2 | caption oi`.
+        Comandos disponíveis: hue, tint, invert, reverse, rotate, square, roundcorners, deepfry, resize, fps, speed,
+        random, caption, esmcaption, meme e motivate.
+
+        :param ctx: contexto de discord
+        :param steps: Os comandos e seus argumentos, separados por `|`. No máximo 10 comandos.
+        :mediaparam media: Um vídeo, gif ou imagem.
+        """
+        parsed = processing.chain.parse(steps)
+        await process(ctx, processing.chain.run_chain, [["VIDEO", "GIF", "IMAGE"]], parsed,
+                      cache=processing.chain.deterministic(parsed))
+
     @commands.hybrid_command(aliases=["shuffle", "stutter", "nervous"])
     async def random(self, ctx, frames: commands.Range[int, 2, 512] = 30):
         """
@@ -375,7 +393,7 @@ class Media(commands.Cog, name="Edição"):
         :param frames: Set size in number of frames of internal cache. must be between 2 and 512. default is 30.
         :mediaparam video: A video or gif.
         """
-        await process(ctx, processing.ffmpeg.random, [["VIDEO", "GIF"]], frames)
+        await process(ctx, processing.ffmpeg.random, [["VIDEO", "GIF"]], frames, cache=False)
 
     @commands.hybrid_command()
     async def reverse(self, ctx):
@@ -1,5 +1,6 @@
 import asyncio
 import inspect
+import time
 import typing
 
 import discord
@@ -9,15 +10,41 @@ import config
 import processing.common
 import processing.ffmpeg
 import processing.ffprobe
-from core import v2queue
+import processing.pipeline
+from core import resultcache, runtimestats, v2queue
 from core.clogs import logger
 from utils.scandiscord import imagesearch
 from utils.web import saveurls
 import utils.tempfiles
 
 
+async def job_work(files: list[str]) -> float:
+    """
+    tamanho da tarefa para o v2queue e o core.runtimestats, pela sondagem das entradas: pixels × quadros
+    """
+    work = 0
+    for file in files:
+        info = await processing.ffprobe.probe(file)
+        # ensuresize e ensureduration ainda vão limitar a entrada
+        w = min(info.width or 0, config.max_size)
+        h = min(info.height or 0, config.max_size)
+        frames = info.frame_count or (info.fps or 0) * (info.duration or 0) or 1
+        if hasattr(config, "max_frames") and config.max_frames:
+            frames = min(frames, config.max_frames)
+        work += w * h * frames
+    return work
+
+
+def format_eta(seconds: float) -> str:
+    seconds = round(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    return f"{seconds // 60}min {seconds % 60}s"
+
+
 async def process(ctx: commands.Context, func: callable, inputs: list, *args,
-                  resize=True, expectimage=True, uploadresult=True, queue=True, run_parallel=False, **kwargs):
+                  resize=True, expectimage=True, uploadresult=True, queue=True, run_parallel=False, cache=True,
+                  **kwargs):
     """
     A função principal do bot. Reúne a mídia e a envia para a função apropriada.
 
@@ -32,6 +59,8 @@ async def process(ctx: commands.Context, func: callable, inputs: list, *args,
     :param uploadresult: se true, carrega o resultado automaticamente.
     :param queue: se verdadeiro, o comando deve aguardar o slot aberto na fila para processar.
     :param run_parallel: apenas para funções de sincronização, execute sem bloquear
+    :param cache: se verdadeiro, o resultado pode vir de/ir para o core.resultcache. desative para comandos
+        não determinísticos.
     :return: nome do arquivo da mídia processada
     """
 
@@ -62,10 +91,17 @@ async def process(ctx: commands.Context, func: callable, inputs: list, *args,
             if inputs:
                 urls = await imagesearch(ctx, len(inputs))
                 files = await saveurls(urls)
+                # só as entradas baixadas vão para o cache de sondagens no banco de dados, o resto da sessão usa a
+                # memorizada
+                for file in files:
+                    await processing.ffprobe.probe(file, persist=True)
             else:
                 files = []
             # if media found or none needed
             if files or not inputs:
+                # comandos que são só um filtro rodam com ensuresize/ensureduration/reencode em um único ffmpeg
+                fuse = expectimage and len(files) == 1 and processing.pipeline.fusible(func)
+                downloaded = list(files)
                 # check that each file is correct type
                 for i, file in enumerate(files):
                     # if file is incorrect type
@@ -83,20 +119,46 @@ async def process(ctx: commands.Context, func: callable, inputs: list, *args,
                                                           f"para o qual o FFmpeg e o Gifmaker têm suporte limitado. Ex"
                                                           f"pect errors.", delete_after=10))
                         # resize if needed
-                        if resize:
+                        if resize and not fuse:
                             files[i] = await processing.ffmpeg.ensuresize(ctx, file, config.min_size, config.max_size)
                 # files are of correcte type, begin to process
                 else:
+                    cachekey = None
+                    if cache and expectimage and resultcache.cache.max_bytes:
+                        # com as entradas como baixadas, antes de ensuresize
+                        cachekey = await resultcache.cache_key(func, downloaded, args, kwargs, resize,
+                                                               await ctx.bot.is_owner(ctx.author))
+                    cached = resultcache.get(cachekey) if cachekey is not None else None
+                    command = getattr(func, "__name__", "")
+                    work = await job_work(files) if not cached else 0
+                    # comandos sem mídia ocupam um worker
+                    cost = v2queue.cost(work, command) if files else 1
+
                     # only update with queue message if there is a queue
-                    if queue and v2queue.sem.locked():
-                        await updatestatus("Seu comando está na fila...")
+                    async def queuestatus(position, eta):
+                        # só informativo, uma edição que falhar (rate limit, mensagem apagada...) não cancela o comando
+                        try:
+                            await updatestatus(f"Seu comando está na fila (posição {position}, começa em cerca de "
+                                               f"{format_eta(eta)})...")
+                        except discord.HTTPException as e:
+                            logger.warning(f"falha ao atualizar a posição na fila: {e}")
 
                     # run func
                     async def run():
-                        nonlocal args
-                        nonlocal files
                         logger.info("Em processamento...")
                         await updatestatus("Em processamento...")
+                        start = time.perf_counter()
+                        command_result = await execute()
+                        # só o tempo de execução, sem a espera na fila
+                        runtimestats.record(command, work, time.perf_counter() - start)
+                        return command_result
+
+                    async def execute():
+                        nonlocal args
+                        nonlocal files
+                        if fuse:
+                            return await processing.pipeline.fused_command(ctx, files[0], func, *args, resize=resize,
+                                                                           **kwargs)
                         # remove too long videossss
                         for i, f in enumerate(files):
                             files[i] = await processing.ffmpeg.ensureduration(f, ctx)
@@ -120,11 +182,16 @@ async def process(ctx: commands.Context, func: callable, inputs: list, *args,
                         return command_result
 
                     # only queue if needed
-                    if queue:
-                        async with v2queue.sem:
+                    if cached:
+                        result = cached
+                    elif queue:
+                        async with v2queue.slot(cost, ctx.guild.id if ctx.guild else None, ctx.author.id,
+                                                v2queue.runtime(work, command) if files else None, queuestatus):
                             result = await run()
                     else:
                         result = await run()
+                    if cachekey is not None and not cached and result:
+                        resultcache.put(cachekey, result)
                     # check results are as expected
                     if expectimage:  # file expected
                         if not result:
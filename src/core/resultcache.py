@@ -0,0 +1,72 @@
+"""
+cache em disco dos resultados de process(), com chave (hash das entradas, função, args)
+"""
+import hashlib
+import json
+import typing
+
+import config
+import processing.ffprobe
+from utils.diskcache import DiskCache
+
+cache = DiskCache("mediaforge-results",
+                  config.result_cache_size if hasattr(config, "result_cache_size") else 500_000_000)
+
+
+# mude quando os comandos passarem a gerar resultados diferentes, para não servir os antigos
+version = 1
+# opções do config que mudam os resultados além dos args de cada comando
+config_options = ["min_size", "max_size", "max_frames", "max_fps", "file_upload_limit", "intermediate_codec",
+                  "capvideo_mode"]
+
+
+def init():
+    cache.init()
+
+
+def fingerprint() -> list:
+    """
+    versão e opções do config que entram em todas as chaves, então mudar o config ou atualizar o bot não serve
+    resultados antigos
+    """
+    return [version, *[getattr(config, option, None) for option in config_options]]
+
+
+def normalize_arg(arg):
+    # discord.Color, ImageSize, etc. só precisam de uma representação estável
+    return repr(arg)
+
+
+async def cache_key(func: typing.Callable, files: list[str], args: tuple, kwargs: dict, *extra) -> str:
+    """
+    gera a chave do cache para uma execução de process()
+    :param func: função do comando
+    :param files: arquivos de entrada, como baixados
+    :param args: args que não são mídia
+    :param kwargs: kwargs passados para func
+    :param extra: qualquer outra coisa que mude o resultado (redimensionamento, isenções do proprietário)
+    :return: hex digest
+    """
+    digests = [await processing.ffprobe.file_digest(f) for f in files]
+    blob = json.dumps([fingerprint(), f"{func.__module__}.{func.__qualname__}", digests, list(args), kwargs,
+                       list(extra)], default=normalize_arg, sort_keys=True)
+    return hashlib.blake2b(blob.encode(), digest_size=16).hexdigest()
+
+
+def get(key: str) -> str | None:
+    """
+    procura um resultado no cache
+    :param key: chave de cache_key()
+    :return: arquivo temporário com o resultado, ou None se não estiver no cache
+    """
+    return cache.get(key)
+
+
+def put(key: str, file: str):
+    """
+    guarda um resultado no cache
+    :param key: chave de cache_key()
+    :param file: arquivo resultante
+    """
+    if key not in cache:
+        cache.put(key, file)
@@ -0,0 +1,100 @@
+"""
+histogramas do tempo de execução dos comandos, por comando e faixa de tamanho da entrada. usados para a posição e o
+ETA na fila de process() e para as estimativas de custo do v2queue. ficam na memória e são gravados no banco de dados
+periodicamente.
+"""
+import asyncio
+import json
+import math
+
+import config
+from core import database
+from core.clogs import logger
+
+# limites superiores das faixas do histograma, em segundos. a última faixa é tudo acima do último limite
+edges = [.5, 1, 2, 4, 8, 15, 30, 60, 120, 300]
+# valor representativo de cada faixa
+midpoints = [edges[0] / 2, *[(low + high) / 2 for low, high in zip(edges, edges[1:])], edges[-1] * 1.5]
+# quando um histograma passa de tantas amostras, as contagens caem pela metade, então as antigas perdem peso
+max_samples = 200
+# amostras necessárias para confiar em um histograma
+min_samples = 3
+# segundos entre gravações no banco de dados
+flush_interval = config.runtime_stats_flush if hasattr(config, "runtime_stats_flush") else 300
+
+# (comando, faixa de tamanho): contagens por faixa de tempo
+histograms: dict[tuple[str, int], list[float]] = {}
+# chaves alteradas desde a última gravação
+dirty: set[tuple[str, int]] = set()
+flush_task: asyncio.Task | None = None
+
+
+def size_bucket(work: float) -> int:
+    # faixas de 4x em pixels × quadros
+    return int(math.log(max(work, 1), 4))
+
+
+def record(command: str, work: float, seconds: float):
+    """
+    registra uma execução
+    :param command: nome da função do comando
+    :param work: pixels × quadros das entradas
+    :param seconds: tempo de execução
+    """
+    key = (command, size_bucket(work))
+    counts = histograms.setdefault(key, [0.0] * len(midpoints))
+    counts[next((i for i, edge in enumerate(edges) if seconds <= edge), len(edges))] += 1
+    if sum(counts) > max_samples:
+        histograms[key] = [c / 2 for c in counts]
+    dirty.add(key)
+
+
+def estimate(command: str, work: float) -> float | None:
+    """
+    tempo de execução esperado de um comando
+    :param command: nome da função do comando
+    :param work: pixels × quadros das entradas
+    :return: média do histograma em segundos, ou None se ainda não houver amostras suficientes
+    """
+    counts = histograms.get((command, size_bucket(work)))
+    if counts is None or (total := sum(counts)) < min_samples:
+        return None
+    return sum(c * m for c, m in zip(counts, midpoints)) / total
+
+
+async def load():
+    async with database.db.execute("SELECT command, bucket, counts FROM runtime_stats") as cur:
+        async for command, bucket, counts in cur:
+            histograms[command, bucket] = json.loads(counts)
+    logger.debug(f"{len(histograms)} histogramas de tempo de execução carregados")
+
+
+async def flush():
+    if not dirty:
+        return
+    rows = [(command, bucket, json.dumps(histograms[command, bucket])) for command, bucket in dirty]
+    dirty.clear()
+    await database.db.executemany("REPLACE INTO runtime_stats(command, bucket, counts) VALUES (?,?,?)", rows)
+    await database.db.commit()
+    logger.debug(f"{len(rows)} histogramas de tempo de execução gravados")
+
+
+async def flush_loop():
+    while True:
+        await asyncio.sleep(flush_interval)
+        try:
+            await flush()
+        except Exception as e:
+            logger.error(e, exc_info=(type(e), e, e.__traceback__))
+
+
+async def init():
+    global flush_task
+    await load()
+    flush_task = asyncio.create_task(flush_loop())
+
+
+async def close():
+    if flush_task is not None:
+        flush_task.cancel()
+    await flush()
@@ -1,25 +1,245 @@
 import asyncio
+import contextlib
+import dataclasses
+import heapq
 import os
+import time
 import typing
 
 import config
+from core import runtimestats
 
 workers = config.workers or os.cpu_count() or 1
-sem = asyncio.Semaphore(workers)
+# orçamento de cpu, em workers. cada tarefa reserva o custo estimado dela (veja cost()) em vez de uma vaga inteira,
+# então várias tarefas pequenas rodam no espaço de uma grande
+budget = float(workers)
+used = 0.0
+# tarefas na fila ou rodando
 queued = 0
+# pixels × quadros que ocupam um worker inteiro (10s de 720p a 30fps)
+work_per_worker = 1280 * 720 * 300
+# segundos de execução de uma tarefa de custo 1 sem amostras no core.runtimestats, só para o ETA
+seconds_per_worker = 10
+# intervalo entre atualizações da posição e do ETA de uma tarefa esperando, veja slot()
+update_interval = 10
+# custo mínimo, para que tarefas pequenas não rodem sem limite ao mesmo tempo
+min_cost = .25
+# uma tarefa pode ser ultrapassada por tarefas menores no máximo tantas vezes, depois ninguém passa na frente dela
+max_bypass = 2 * workers
+# ordena a fila por justiça entre guilds e usuários em vez de ordem de chegada, veja fair_order()
+fair = config.fair_queue if hasattr(config, "fair_queue") else True
+# peso aproximado de cada comando por pixel × quadro, pelo nome da função. o resto pesa 1
+command_factors = {
+    # precisam de todos os quadros na memória antes de escrever o primeiro
+    "reverse": 2,
+    "videoloop": 2,
+    "random": 1.5,
+    "deepfry": 1.5,
+    # reencodes a uma taxa baixa, mais o reencode normal
+    "quality": 1.5,
+    # várias etapas
+    "run_chain": 3,
+}
 
 
-async def enqueue(task: typing.Coroutine):
-    global queued
+@dataclasses.dataclass(eq=False)
+class Job:
+    cost: float
+    ready: asyncio.Future
+    # guild (ou ("dm", usuário) fora de guilds) e usuário que pediram
+    guild: typing.Hashable = None
+    user: typing.Hashable = None
+    # tempo de execução esperado, em segundos
+    runtime: float = 0
+    # time.monotonic() da admissão
+    started: float | None = None
+    # quantas tarefas de trás já foram admitidas antes desta
+    bypassed: int = 0
+
+
+# tarefas esperando, em ordem de chegada
+waiting: list[Job] = []
+# tarefas admitidas que ainda não terminaram
+running: list[Job] = []
+# serviço recebido, a soma dos custos admitidos, por guild e por (guild, usuário). só de quem tem tarefas na fila ou
+# rodando, veja prune()
+service: dict[typing.Hashable, float] = {}
+
+
+def cost(work: float, command: str = "") -> float:
+    """
+    estima quanto do orçamento (fração da cpu) uma tarefa usa. o tempo de execução medido não entra aqui: uma tarefa
+    lenta de uma thread só ocuparia o orçamento inteiro
+    :param work: pixels × quadros das entradas
+    :param command: nome da função do comando, veja command_factors
+    :return: custo em workers, entre min_cost e budget
+    """
+    return min(max(work * command_factors.get(command, 1) / work_per_worker, min_cost), budget)
+
+
+def runtime(work: float, command: str = "") -> float:
+    """
+    tempo de execução esperado de uma tarefa, em segundos, para a posição e o ETA. vem do core.runtimestats quando
+    ele já tem amostras do comando nesse tamanho
+    """
+    seconds = runtimestats.estimate(command, work)
+    return seconds if seconds is not None else cost(work, command) * seconds_per_worker
+
+
+def free() -> float:
+    return budget - used
+
+
+def activate(job: Job):
+    """
+    uma guild ou usuário que volta a ter tarefas na fila começa do menor serviço entre os que já estão esperando, para
+    que o tempo ocioso não vire crédito acumulado
+    """
+    guilds = {j.guild for j in waiting}
+    if guilds and job.guild not in guilds:
+        service[job.guild] = max(service.get(job.guild, 0), min(service.get(g, 0) for g in guilds))
+    users = {(j.guild, j.user) for j in waiting if j.guild == job.guild}
+    if users and (job.guild, job.user) not in users:
+        service[job.guild, job.user] = max(service.get((job.guild, job.user), 0),
+                                           min(service.get(u, 0) for u in users))
+
+
+def fair_order() -> list[Job]:
+    """
+    ordem de admissão das tarefas esperando, como um deficit round robin em dois níveis: a guild que recebeu menos
+    serviço vai primeiro e, dentro dela, o usuário que recebeu menos. cada guild e usuário mantém a ordem de chegada,
+    então quem lota a fila só atrasa as próprias tarefas
+    """
+    if not fair:
+        return list(waiting)
+    queues: dict[typing.Hashable, dict[typing.Hashable, list[Job]]] = {}
+    for job in waiting:
+        queues.setdefault(job.guild, {}).setdefault(job.user, []).append(job)
+    served = {key: service.get(key, 0) for key in
+              [*queues, *[(g, u) for g, users in queues.items() for u in users]]}
+    order = []
+    while queues:
+        # empates ficam com quem chegou primeiro
+        guild = min(queues, key=served.get)
+        users = queues[guild]
+        user = min(users, key=lambda u: served[guild, u])
+        job = users[user].pop(0)
+        order.append(job)
+        served[guild] += job.cost
+        served[guild, user] += job.cost
+        if not users[user]:
+            del users[user]
+        if not users:
+            del queues[guild]
+    return order
+
+
+def dispatch():
+    """
+    admite as tarefas que cabem no orçamento livre, na ordem de fair_order(). tarefas pequenas podem passar na frente
+    de uma grande que não cabe ainda (backfill), até que ela tenha sido ultrapassada max_bypass vezes
+    """
+    global used
+    skipped = []
+    for job in fair_order():
+        if job.cost <= free() + 1e-9:
+            waiting.remove(job)
+            running.append(job)
+            job.started = time.monotonic()
+            used += job.cost
+            service[job.guild] = service.get(job.guild, 0) + job.cost
+            service[job.guild, job.user] = service.get((job.guild, job.user), 0) + job.cost
+            job.ready.set_result(None)
+            for other in skipped:
+                other.bypassed += 1
+        else:
+            skipped.append(job)
+            # reserva o orçamento que for liberando para ela
+            if job.bypassed >= max_bypass:
+                break
+
+
+def prune():
+    """
+    esquece o serviço de guilds e usuários sem tarefas esperando ou rodando, para que service não cresça com cada
+    usuário que já passou pelo bot. quando voltam, activate() os põe no nível de quem está esperando
+    """
+    active = {key for job in [*waiting, *running] for key in [job.guild, (job.guild, job.user)]}
+    for key in [key for key in service if key not in active]:
+        del service[key]
+
+
+def position(job: Job) -> int:
+    """
+    posição atual de uma tarefa esperando, começando em 1
+    """
+    return fair_order().index(job) + 1
+
+
+def eta(job: Job) -> float:
+    """
+    segundos até uma tarefa esperando começar, simulando as tarefas rodando e as da frente com os tempos esperados
+    """
+    now = time.monotonic()
+    # (fim, custo) das tarefas ocupando o orçamento
+    ends = [(max(j.started + j.runtime, now), j.cost) for j in running]
+    heapq.heapify(ends)
+    available = free()
+    start = now
+    for other in fair_order():
+        while available + 1e-9 < other.cost and ends:
+            end, released = heapq.heappop(ends)
+            start = max(start, end)
+            available += released
+        if other is job:
+            return start - now
+        heapq.heappush(ends, (start + other.runtime, other.cost))
+        available -= other.cost
+    return 0
+
+
+@contextlib.asynccontextmanager
+async def slot(job_cost: float = 1, guild: typing.Hashable = None, user: typing.Hashable = None,
+               job_runtime: float | None = None,
+               on_wait: typing.Callable[[int, float], typing.Awaitable] | None = None):
+    """
+    espera até que job_cost do orçamento esteja livre e o reserva enquanto o contexto estiver aberto
+    :param job_cost: veja cost()
+    :param guild: id da guild que pediu, ou None fora de guilds
+    :param user: id do usuário que pediu
+    :param job_runtime: tempo de execução esperado para o ETA das outras tarefas, veja runtime()
+    :param on_wait: se a tarefa tiver que esperar, chamada com (posição, ETA em segundos) logo e a cada
+        update_interval segundos até começar
+    :return: a Job
+    """
+    global used, queued
     queued += 1
-    # permite apenas uma certa quantidade de tarefas dentro do contexto de uma só vez
-    # testes rápidos mostram que é aproximadamente FIFO, mas existem bibliotecas, se necessário
-    async with sem:
-        try:
-            res = await task
-        except Exception as e:
-            queued -= 1
-            raise e
+    job = Job(min(job_cost, budget), asyncio.get_running_loop().create_future(),
+              guild if guild is not None else ("dm", user), user,
+              job_runtime if job_runtime is not None else job_cost * seconds_per_worker)
+    activate(job)
+    waiting.append(job)
+    dispatch()
+    try:
+        while not job.ready.done():
+            if on_wait is not None:
+                await on_wait(position(job), eta(job))
+            await asyncio.wait([job.ready], timeout=update_interval)
+        yield job
+    finally:
+        queued -= 1
+        if job in waiting:
+            # cancelada antes de começar
+            waiting.remove(job)
         else:
-            queued -= 1
-            return res
+            running.remove(job)
+            used -= job.cost
+        dispatch()
+        prune()
+
+
+async def enqueue(task: typing.Coroutine, job_cost: float = 1, guild: typing.Hashable = None,
+                  user: typing.Hashable = None):
+    # permite apenas tarefas que cabem no orçamento dentro do contexto de uma só vez
+    async with slot(job_cost, guild, user):
+        return await task
@@ -39,7 +39,12 @@ except ModuleNotFoundError as e:
 
 # project files
 import core.database
-from core import heartbeat
+import core.runtimestats
+import processing.common
+import processing.ffprobe
+from core import heartbeat, resultcache
+from utils import web
+import processing.vips.vipsutils
 from utils.common import *
 from core.clogs import logger
 import config
@@ -131,6 +136,15 @@ def initdbsync():
         cur = syncdb.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='bans'")
         if not cur.fetchall():
             syncdb.execute("create table bans ( user int not null constraint bans_pk primary key, banreason text );  ")
+        cur = syncdb.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='probe_cache'")
+        if not cur.fetchall():
+            syncdb.execute("create table probe_cache ( hash text not null constraint probe_cache_pk primary key, "
+                           "info text not null, last_used real not null ); ")
+            syncdb.execute("create index probe_cache_last_used on probe_cache (last_used); ")
+        cur = syncdb.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='runtime_stats'")
+        if not cur.fetchall():
+            syncdb.execute("create table runtime_stats ( command text not null, bucket int not null, "
+                           "counts text not null, constraint runtime_stats_pk primary key (command, bucket) ); ")
     syncdb.close()
 
 
@@ -139,12 +153,18 @@ def init():
     downloadttsvoices()
     heartbeat.init()
     tempfiles.init()
+    resultcache.init()
+    web.downloads.init()
+    processing.vips.vipsutils.render_cache.init()
 
 
 class MyBot(commands.AutoShardedBot):
     async def setup_hook(self):
         logger.debug(f"inicializando engrenagens")
         await core.database.init_database()
+        await core.runtimestats.init()
+        await init_http_session()
+        await processing.common.init_pool()
         if config.bot_list_data:
             logger.info("dados da lista de bots encontrados. botblock iniciará quando o bot estiver pronto.")
             await bot.add_cog(DiscordListsPost(bot))
@@ -164,6 +184,13 @@ class MyBot(commands.AutoShardedBot):
 
         )
 
+    async def close(self):
+        await core.runtimestats.close()
+        await processing.ffprobe.probe_cache_flush()
+        await super().close()
+        await close_http_session()
+        processing.common.shutdown_executors()
+
 
 if __name__ == "__main__":
     logger.log(25, "Olá Mundo!")
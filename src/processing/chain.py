@@ -0,0 +1,181 @@
+"""
+comando chain: vários comandos de edição na mesma mídia, como um único pipeline.
+a mídia é baixada e sondada uma vez, as etapas intermediárias ficam sem perdas (sem reencode/assurefilesize a cada
+etapa) e as etapas que são só um filtro são fundidas pelo processing.pipeline.
+"""
+import dataclasses
+import typing
+
+import discord
+from discord.ext import commands
+
+import config
+import processing.ffmpeg
+import processing.pipeline
+import processing.vips.caption
+import processing.vips.vipsutils
+from processing.common import NonBugError
+from processing.ffprobe import mediatype
+
+# limite de etapas por chain, cada uma ainda pode ser uma execução inteira do ffmpeg
+max_steps = 10
+
+
+def ranged(convert: typing.Callable, low=None, high=None):
+    # como commands.Range, para os args das etapas
+    def converter(arg: str):
+        try:
+            value = convert(arg)
+        except ValueError:
+            raise commands.BadArgument(f"`{arg}` não é um {convert.__name__} válido.")
+        if low is not None and value < low:
+            raise commands.BadArgument(f"`{arg}` deve ser pelo menos {low}.")
+        if high is not None and value > high:
+            raise commands.BadArgument(f"`{arg}` deve ser no máximo {high}.")
+        return value
+
+    converter.__name__ = convert.__name__
+    return converter
+
+
+def choice(*options: str):
+    def converter(arg: str):
+        if arg not in options:
+            raise commands.BadArgument(f"`{arg}` deve ser um destes: {', '.join(options)}.")
+        return arg
+
+    return converter
+
+
+def color(arg: str):
+    try:
+        return discord.Color.from_str(arg)
+    except ValueError:
+        raise commands.BadArgument(f"`{arg}` não é uma cor válida.")
+
+
+def dimension(arg: str):
+    value = ranged(int, -1, config.max_size)(arg)
+    if value == 0:
+        raise commands.BadArgument(f"A largura e a altura devem estar entre 1 e {config.max_size}, ou -1.")
+    return value
+
+
+@dataclasses.dataclass
+class Step:
+    """
+    uma etapa disponível no chain
+    """
+    # função de processing com a mídia como primeiro arg
+    func: typing.Callable
+    # conversores dos args, na ordem
+    params: list[typing.Callable[[str], typing.Any]] = dataclasses.field(default_factory=list)
+    # valores dos últimos params quando não são informados
+    defaults: tuple = ()
+    # args fixos passados antes dos convertidos
+    prefix: tuple = ()
+    # se definido, a etapa recebe todo o resto do texto, transformado por esta função, em vez de params
+    text: typing.Callable[[str], typing.Any] | None = None
+    types: tuple[str, ...] = ("VIDEO", "GIF", "IMAGE")
+    # o resultado muda a cada execução, então o chain não pode ir para o cache de resultados
+    deterministic: bool = True
+
+
+steps: dict[str, Step] = {
+    "hue": Step(processing.ffmpeg.hue, [ranged(float)]),
+    "tint": Step(processing.ffmpeg.tint, [color]),
+    "invert": Step(processing.ffmpeg.invert),
+    "reverse": Step(processing.ffmpeg.reverse, types=("VIDEO", "GIF")),
+    "rotate": Step(processing.ffmpeg.rotate, [choice("90", "90ccw", "180", "vflip", "hflip")]),
+    "square": Step(processing.ffmpeg.pad),
+    "roundcorners": Step(processing.ffmpeg.round_corners, [ranged(int, 0)], defaults=(10,)),
+    "deepfry": Step(processing.ffmpeg.deepfry,
+                    [ranged(float, -1, 1), ranged(float, 0, 5), ranged(float, 0, 5), ranged(float, 0, 3),
+                     ranged(float, 0, 100)], defaults=(0.5, 1.5, 1.5, 1.5, 20)),
+    "resize": Step(processing.ffmpeg.resize, [dimension, dimension]),
+    "fps": Step(processing.ffmpeg.changefps, [ranged(float, 1, 60)], types=("VIDEO", "GIF")),
+    "speed": Step(processing.ffmpeg.speed, [ranged(float, 0.25, 100)], defaults=(2,), types=("VIDEO", "GIF")),
+    "random": Step(processing.ffmpeg.random, [ranged(int, 2, 512)], defaults=(30,), types=("VIDEO", "GIF"),
+                   deterministic=False),
+    "caption": Step(processing.vips.vipsutils.generic_caption_stack,
+                    prefix=(processing.vips.caption.mediaforge_caption,), text=lambda t: [t]),
+    "esmcaption": Step(processing.vips.vipsutils.generic_caption_stack, prefix=(processing.vips.caption.esmcaption,),
+                       text=lambda t: [t]),
+    # "|" separa as etapas, então só o texto de cima
+    "meme": Step(processing.vips.vipsutils.generic_caption_overlay, prefix=(processing.vips.caption.meme,),
+                 text=lambda t: [t, ""]),
+    "motivate": Step(processing.ffmpeg.motivate, text=lambda t: [t, ""]),
+}
+aliases = {
+    "pad": "square",
+    "color": "tint",
+    "recolor": "tint",
+    "negate": "invert",
+    "flip": "rotate",
+    "rot": "rotate",
+    "size": "resize",
+    "cap": "caption",
+    "shuffle": "random",
+    "round": "roundcorners",
+    "demotivate": "motivate",
+}
+
+
+def parse(text: str) -> list[tuple[str, tuple]]:
+    """
+    lê as etapas de um chain
+    :param text: comandos e seus args separados por |, como `hue 90 | speed 2 | caption oi`
+    :return: lista de (nome da etapa, args convertidos)
+    """
+    parsed = []
+    for part in text.split("|"):
+        name, _, rest = part.strip().partition(" ")
+        name = aliases.get(name.lower(), name.lower())
+        if name not in steps:
+            raise commands.BadArgument(f"`{name}` não pode ser usado no chain. "
+                                       f"Comandos disponíveis: {', '.join(f'`{s}`' for s in steps)}")
+        step = steps[name]
+        rest = rest.strip()
+        if step.text:
+            if not rest:
+                raise commands.BadArgument(f"`{name}` precisa de um texto.")
+            args = (step.text(rest),)
+        else:
+            tokens = rest.split()
+            required = len(step.params) - len(step.defaults)
+            if not required <= len(tokens) <= len(step.params):
+                raise commands.BadArgument(f"`{name}` recebe de {required} a {len(step.params)} argumentos.")
+            args = tuple(convert(token) for convert, token in zip(step.params, tokens)) + \
+                   step.defaults[len(tokens) - required:]
+        parsed.append((name, args))
+    if len(parsed) > max_steps:
+        raise commands.BadArgument(f"Um chain pode ter no máximo {max_steps} comandos.")
+    return parsed
+
+
+def deterministic(parsed: list[tuple[str, tuple]]) -> bool:
+    return all(steps[name].deterministic for name, _ in parsed)
+
+
+async def run_chain(file: str, parsed: list[tuple[str, tuple]]):
+    """
+    executa as etapas de parse() na mídia
+    :param file: mídia de entrada
+    :param parsed: resultado de parse(), só dados para que a chave do cache de resultados seja estável
+    :return: mídia processada, do mesmo tipo que a entrada
+    """
+    mt = await mediatype(file)
+    stages: list[processing.pipeline.Stage] = []
+    if mt == "GIF":
+        # começa sem perdas, senão cada etapa faria o caminho de volta para gif (e perderia cores)
+        stages.append(processing.pipeline.Filter())
+    for name, args in parsed:
+        step = steps[name]
+        if mt not in step.types:
+            raise NonBugError(f"`{name}` não funciona com {mt}.")
+        args = step.prefix + args
+        if step.func in processing.pipeline.chain_filters:
+            stages.append(processing.pipeline.chain_filters[step.func](*args))
+        else:
+            stages.append(processing.pipeline.Call(step.func, args))
+    return await processing.pipeline.run(file, stages, mt)
@@ -1,12 +1,17 @@
 import asyncio
 import concurrent.futures
+import contextvars
 import functools
+import glob
+import multiprocessing
 import os
 import subprocess
 import sys
 import typing
 
+import config
 import utils.tempfiles
+from core import v2queue
 from core.clogs import logger
 from utils.tempfiles import reserve_tempfile
 
@@ -27,6 +32,24 @@ class ReturnedNothing(Exception):
     pass
 
 
+def nice_kwargs():
+    # https://stackoverflow.com/a/56884806/9044183
+    # definir baixa prioridade do processo
+    if sys.platform == "win32":
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.BELOW_NORMAL_PRIORITY_CLASS
+        return {"startupinfo": startupinfo}
+    else:
+        return {"preexec_fn": lambda: os.nice(10)}
+
+
+def decode_output(stdout: bytes, stderr: bytes) -> str:
+    try:
+        return stdout.decode().strip() + stderr.decode().strip()
+    except UnicodeDecodeError:
+        return stdout.decode("ascii", 'ignore').strip() + stderr.decode("ascii", 'ignore').strip()
+
+
 # https://fredrikaverpil.github.io/2017/06/20/async-and-await-with-subprocesses/
 async def run_command(*args: str):
     """
@@ -36,19 +59,10 @@ async def run_command(*args: str):
     :return: o resultado do comando
     """
 
-    # https://stackoverflow.com/a/56884806/9044183
-    # definir baixa prioridade do processo
-    if sys.platform == "win32":
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.BELOW_NORMAL_PRIORITY_CLASS
-        nicekwargs = {"startupinfo": startupinfo}
-    else:
-        nicekwargs = {"preexec_fn": lambda: os.nice(10)}
-
     # Criar subprocesso
     process = await asyncio.create_subprocess_exec(
         *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
-        **nicekwargs
+        **nice_kwargs()
     )
 
     # Status
@@ -56,12 +70,15 @@ async def run_command(*args: str):
     logger.debug(f"PID {process.pid}: {args}")
 
     # Aguarde a conclusão do subprocesso
-    stdout, stderr = await process.communicate()
-
     try:
-        result = stdout.decode().strip() + stderr.decode().strip()
-    except UnicodeDecodeError:
-        result = stdout.decode("ascii", 'ignore').strip() + stderr.decode("ascii", 'ignore').strip()
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        # a tarefa foi cancelada (ex. um candidato que perdeu em first_fit()), o processo não deve continuar sozinho
+        process.kill()
+        await process.wait()
+        raise
+
+    result = decode_output(stdout, stderr)
     # Progresso
     if process.returncode == 0:
         logger.debug(f"PID {process.pid} Done.")
@@ -79,6 +96,132 @@ async def run_command(*args: str):
     return result
 
 
+async def run_piped(*commands: typing.Sequence[str]):
+    """
+    executa comandos cli ligados por pipes do SO, como `a | b | c`. o stdout de cada um é o stdin do próximo e todos
+    rodam ao mesmo tempo, então nada é escrito em disco entre eles. se qualquer um falhar, os outros são encerrados.
+
+    :param commands: os args de cada comando, na ordem
+    :return: o resultado do último comando
+    """
+    processes = []
+    stdin = None
+    try:
+        for i, args in enumerate(commands):
+            last = i == len(commands) - 1
+            read, write = (None, None) if last else os.pipe()
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *args, stdin=stdin, stdout=asyncio.subprocess.PIPE if last else write,
+                    stderr=asyncio.subprocess.PIPE, **nice_kwargs()
+                )
+            finally:
+                # os filhos têm suas cópias, as nossas impediriam o EOF
+                if write is not None:
+                    os.close(write)
+                if stdin is not None:
+                    os.close(stdin)
+                stdin = read
+            logger.info(f"'{args[0]}' começou com PID {process.pid} (pipe {i + 1}/{len(commands)})")
+            logger.debug(f"PID {process.pid}: {args}")
+            processes.append(process)
+    except BaseException:
+        if stdin is not None:
+            os.close(stdin)
+        for process in processes:
+            process.kill()
+        raise
+
+    failed = []
+
+    async def wait(process, args):
+        stdout, stderr = await process.communicate()
+        # só o último tem stdout, o dos outros é o pipe
+        result = decode_output(stdout or b"", stderr)
+        if process.returncode != 0:
+            logger.error(f"PID {process.pid} Fracassado: {args} resultado: {result}")
+            failed.append((args, result))
+            # o resto do pipe não tem como terminar direito
+            for other in processes:
+                if other.returncode is None:
+                    other.kill()
+        return result
+
+    try:
+        results = await asyncio.gather(*[wait(p, args) for p, args in zip(processes, commands)])
+    except asyncio.CancelledError:
+        for process in processes:
+            if process.returncode is None:
+                process.kill()
+        raise
+    if failed:
+        # o primeiro a falhar quebrou o pipe, os outros receberam EPIPE ou foram encerrados
+        args, result = failed[0]
+        raise CMDError(f"Comando {args} fracassado.") from CMDError(result)
+    logger.debug(f"PIDs {[p.pid for p in processes]} Done.")
+    return results[-1]
+
+
+def spare_encoders() -> int:
+    """
+    quantas codificações a tarefa atual pode rodar ao mesmo tempo: a sua mais uma por worker livre no orçamento do
+    v2queue, nenhuma extra se houver tarefas esperando
+    """
+    spare = 0 if v2queue.waiting else int(v2queue.free())
+    return max(1, min(1 + spare, os.cpu_count() or 1))
+
+
+async def first_fit(encode: typing.Callable[[typing.Any], typing.Awaitable[str]], candidates: list, maxsize: int):
+    """
+    codifica candidatos até encontrar o maior abaixo de maxsize. com a máquina ociosa, vários rodam ao mesmo tempo
+    (até spare_encoders()) e, quando um cabe, os menores que ainda estão rodando são cancelados. com ela ocupada, é o
+    mesmo que tentar um de cada vez.
+
+    :param encode: recebe um candidato e retorna o arquivo codificado
+    :param candidates: candidatos do maior (preferido) para o menor
+    :param maxsize: tamanho máximo em bytes
+    :return: (candidato, arquivo) do maior candidato que coube, ou None se nenhum coube
+    """
+    limit = spare_encoders()
+    logger.debug(f"codificando {len(candidates)} candidatos, {limit} de cada vez")
+    running: dict[asyncio.Task, int] = {}
+    fits: dict[int, str] = {}
+    done: set[int] = set()
+    cancelled: list[asyncio.Task] = []
+    started = 0
+    try:
+        while True:
+            # não adianta começar candidatos menores que um que já coube
+            while started < len(candidates) and len(running) < limit and not fits:
+                running[asyncio.create_task(encode(candidates[started]))] = started
+                started += 1
+            if not running:
+                return None
+            finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                i = running.pop(task)
+                done.add(i)
+                # exceções dos candidatos sobem normalmente
+                if os.path.getsize(result := task.result()) < maxsize:
+                    fits[i] = result
+            if fits:
+                best = min(fits)
+                for task, i in list(running.items()):
+                    if i > best:
+                        task.cancel()
+                        cancelled.append(task)
+                        del running[task]
+                # só ganha quando todos os maiores terminaram sem caber
+                if all(i in done for i in range(best)):
+                    return candidates[best], fits[best]
+    finally:
+        for task in running:
+            task.cancel()
+        # espera os processos dos cancelados serem encerrados
+        if pending := [*running, *cancelled]:
+            await asyncio.wait(pending)
+
+
 async def tts(text: str, model: typing.Literal["male", "female", "retro"] = "male"):
     ttswav = reserve_tempfile("wav")
     if model == "retro":
@@ -108,18 +251,123 @@ def handle_tfs_parallel(func: typing.Callable, *args, **kwargs):
         return False, e, utils.tempfiles.session.get()
 
 
-async def run_parallel(syncfunc: typing.Callable, *args, **kwargs):
+# pool de processos persistente, criado na primeira chamada de run_parallel() ou por init_pool()
+pool: concurrent.futures.ProcessPoolExecutor | None = None
+# recicla cada worker depois de tantas tarefas, para que vazamentos de memória do libvips não se acumulem
+worker_max_tasks = config.worker_max_tasks if hasattr(config, "worker_max_tasks") else 100
+
+
+# pool de threads para funções @nogil
+thread_pool = concurrent.futures.ThreadPoolExecutor(v2queue.workers, thread_name_prefix="nogil")
+nogil_funcs: set[typing.Callable] = set()
+# pool de threads para funções síncronas que passam o tempo esperando a rede (ex: youtube-dl), separado dos pools de
+# cpu para que um download lento não ocupe um worker
+io_workers = 4
+io_pool = concurrent.futures.ThreadPoolExecutor(io_workers, thread_name_prefix="io")
+
+
+fonts_registered = False
+
+
+def register_fonts():
+    """
+    registra as fontes de rendering/fonts no fontconfig do processo atual.
+    o libvips adiciona cada fontfile à configuração global do fontconfig, então depois disso as funções de texto só
+    precisam do nome da família em font=, sem fontfile= e sem renderizar um "." antes para carregar o twemoji.
     """
-    usa concurrent.futures.ProcessPoolExecutor para executar funções vinculadas à CPU em seu próprio processo
+    global fonts_registered
+    if fonts_registered:
+        return
+    import pyvips
+    for font in glob.glob("rendering/fonts/*"):
+        pyvips.Image.text(".", fontfile=font)
+    fonts_registered = True
 
-    :param syncfunc: a função de bloqueio
-    :return: o resultado da função de bloqueio
+
+def init_worker():
+    # paga o custo de importar pyvips e carregar as fontes uma vez por worker, não uma vez por tarefa
+    register_fonts()
+    logger.debug(f"worker {os.getpid()} pronto")
+
+
+def warm_worker():
+    return os.getpid()
+
+
+def get_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global pool
+    if pool is None:
+        # max_tasks_per_child não funciona com fork
+        pool = concurrent.futures.ProcessPoolExecutor(v2queue.workers,
+                                                      mp_context=multiprocessing.get_context("spawn"),
+                                                      initializer=init_worker,
+                                                      max_tasks_per_child=worker_max_tasks)
+    return pool
+
+
+async def init_pool():
     """
-    # criar um novo pool de processos não parece ter muita sobrecarga, mas reutilizar um já existente causa PAin
-    with concurrent.futures.ProcessPoolExecutor(1) as pool:
+    cria o pool e inicia todos os workers antes do primeiro comando
+    """
+    loop = asyncio.get_running_loop()
+    # as threads também usam as fontes, mas dentro deste processo
+    await loop.run_in_executor(thread_pool, init_worker)
+    pids = await asyncio.gather(*[loop.run_in_executor(get_pool(), warm_worker) for _ in range(v2queue.workers)])
+    logger.debug(f"pool de processos iniciado com workers {set(pids)}")
+
+
+def shutdown_pool():
+    # só o pool de processos, o próximo get_pool() cria outro
+    global pool
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+        pool = None
+
+
+def shutdown_executors():
+    """
+    encerra os pools de processos e de threads quando o bot fecha. os de threads não são recriados depois disso
+    """
+    shutdown_pool()
+    thread_pool.shutdown(wait=False, cancel_futures=True)
+    io_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def nogil(func: typing.Callable):
+    """
+    marca uma função síncrona que passa quase todo o tempo dentro do libvips (que libera o GIL), para que
+    run_parallel() a execute em uma thread do próprio bot em vez de em outro processo
+    """
+    nogil_funcs.add(func)
+    return func
+
+
+async def run_in_thread(syncfunc: typing.Callable, *args, executor: concurrent.futures.Executor | None = None,
+                        **kwargs):
+    # o contexto copiado compartilha a lista da TempFileSession, então reserve_tempfile() funciona normalmente
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        executor or thread_pool, functools.partial(ctx.run, syncfunc, *args, **kwargs)
+    )
+
+
+async def run_io(syncfunc: typing.Callable, *args, **kwargs):
+    """
+    executa uma função síncrona limitada por I/O (rede, disco) sem bloquear, no io_pool, fora dos pools de cpu
+    """
+    return await run_in_thread(syncfunc, *args, executor=io_pool, **kwargs)
+
+
+async def run_in_process(syncfunc: typing.Callable, *args, **kwargs):
+    try:
         success, res, files = await asyncio.get_running_loop().run_in_executor(
-            pool, functools.partial(handle_tfs_parallel, syncfunc, *args, **kwargs)
+            get_pool(), functools.partial(handle_tfs_parallel, syncfunc, *args, **kwargs)
         )
+    except concurrent.futures.process.BrokenProcessPool:
+        # um worker morreu (segfault, oom...), o pool inteiro fica inutilizável, então começa um novo
+        logger.error("pool de processos quebrado, recriando")
+        shutdown_pool()
+        raise
     if files:
         tfs = utils.tempfiles.session.get()
         tfs += files
@@ -128,3 +376,17 @@ async def run_parallel(syncfunc: typing.Callable, *args, **kwargs):
         return res
     else:
         raise res
+
+
+async def run_parallel(syncfunc: typing.Callable, *args, **kwargs):
+    """
+    executa funções vinculadas à CPU sem bloquear. funções marcadas com @nogil rodam no pool de threads, o resto
+    (ex: código PIL como processing.sus.sus) roda no pool de processos persistente
+
+    :param syncfunc: a função de bloqueio
+    :return: o resultado da função de bloqueio
+    """
+    if syncfunc in nogil_funcs:
+        return await run_in_thread(syncfunc, *args, **kwargs)
+    else:
+        return await run_in_process(syncfunc, *args, **kwargs)
@@ -1,5 +1,6 @@
 import glob
 import math
+import shutil
 
 import discord
 import humanize
@@ -13,6 +14,37 @@ import utils.tempfiles
 from processing.ffprobe import *
 from utils.tempfiles import reserve_tempfile
 
+# codecs sem perdas para os intermediários de vídeo/gif: nome -> (extensão do container, args de codificação)
+# todos preservam o canal alfa. o padrão foi escolhido com src/benchmarks/intermediate.py
+# o áudio é fixado também, senão cada container usa o próprio padrão (vorbis/mp2 no nut) e o reencode() final
+# comprime de novo um áudio que já perdeu qualidade. pcm onde o container aceita, aac (como antes) no mp4
+intermediate_codecs = {
+    # o formato antigo. zlib em uma thread só em todos os quadros
+    "png": ("mp4", ["-c:v", "png", "-c:a", "aac", "-q:a", "2"]),
+    # intra-frame com fatias, codifica em várias threads. nut porque o mp4 não aceita ffv1
+    "ffv1": ("nut", ["-c:v", "ffv1", "-level", "3", "-slices", "4", "-slicecrc", "0", "-g", "1", "-c:a", "pcm_s16le"]),
+    "utvideo": ("nut", ["-c:v", "utvideo", "-c:a", "pcm_s16le"]),
+    "qtrle": ("mov", ["-c:v", "qtrle", "-c:a", "pcm_s16le"]),
+    # sem compressão nenhuma, o mais rápido mas ocupa muito do /dev/shm
+    "rawvideo": ("nut", ["-c:v", "rawvideo", "-c:a", "pcm_s16le"]),
+}
+intermediate_codec = config.intermediate_codec if hasattr(config, "intermediate_codec") else "png"
+intermediate_ext, intermediate_args = intermediate_codecs[intermediate_codec]
+# formato entre ffmpegs ligados por pipes, veja run_lossless(). nada vai para o disco, então sem compressão nenhuma
+pipe_args = ["-c:v", "rawvideo", "-c:a", "pcm_s16le", "-f", "nut"]
+
+
+def lossless(outname: str) -> list[str]:
+    """
+    args de codificação sem perdas para um arquivo intermediário. um -c:a depois destes args (como "-c:a copy")
+    continua valendo
+    :param outname: arquivo de saída. imagens .png continuam em png, vídeos e gifs usam config.intermediate_codec
+    :return: args para o ffmpeg, uma lista nova que pode ser alterada
+    """
+    if outname.endswith(".png"):
+        return ["-c:v", "png"]
+    return list(intermediate_args)
+
 
 async def edit_msg_with_webhookmessage_polyfill(msg: typing.Union[discord.Message, discord.WebhookMessage],
                                                 delete_after=None, **kwargs):
@@ -74,8 +106,7 @@ async def ensureduration(media, ctx: commands.Context):
 
 
 async def hasaudio(video):
-    return bool(
-        await run_command("ffprobe", "-i", video, "-show_streams", "-select_streams", "a", "-loglevel", "panic"))
+    return (await probe(video)).has_audio
 
 
 async def forceaudio(video):
@@ -87,79 +118,204 @@ async def forceaudio(video):
     if await hasaudio(video):
         return video
     else:
-        outname = reserve_tempfile("mp4")
-        await run_command("ffmpeg", "-hide_banner", "-i", video, "-f", "lavfi", "-i", "anullsrc", "-c:v", "png",
+        outname = reserve_tempfile(intermediate_ext)
+        await run_command("ffmpeg", "-hide_banner", "-i", video, "-f", "lavfi", "-i", "anullsrc", *lossless(outname),
                           "-c:a", "aac", "-map", "0:v", "-map", "1:a", "-shortest", "-fps_mode", "vfr", outname)
 
         return outname
 
 
+async def forceaudio_input(video) -> tuple[list[str], list[str] | None]:
+    """
+    forceaudio() sem o intermediário: o vídeo com o áudio silencioso vai por um pipe para o próximo ffmpeg
+    :param video: Arquivo
+    :return: (args de entrada do próximo ffmpeg, comando para o source de run_lossless() ou None se já houver áudio)
+    """
+    if await hasaudio(video):
+        return ["-i", video], None
+    return ["-f", "nut", "-i", "pipe:0"], ["ffmpeg", "-hide_banner", "-i", video, "-f", "lavfi", "-i", "anullsrc",
+                                           *pipe_args, "-map", "0:v", "-map", "1:a", "-shortest", "-fps_mode", "vfr",
+                                           "pipe:1"]
+
+
+# frações da taxa (ou do tamanho) alvo que assurefilesize() tenta ao mesmo tempo quando há workers sobrando,
+# veja first_fit()
+candidate_steps = [1, .9, .8, .7]
+# modo de twopasscapvideo(): "auto" escolhe pela precisão medida, "vbv" ou "twopass" forçam um modo
+capvideo_mode = config.capvideo_mode if hasattr(config, "capvideo_mode") else "auto"
+# média móvel da fração das codificações vbv que couberam de primeira, e quantas foram medidas
+vbv_accuracy = 1.0
+vbv_samples = 0
+# no modo auto, o vbv é usado enquanto acertar pelo menos isto. abaixo disso ainda é tentado a cada vbv_explore vídeos,
+# para a medida acompanhar mudanças no tipo de vídeo que chega
+vbv_min_accuracy = .9
+vbv_explore = 10
+capvideo_calls = 0
+
+
+def use_vbv() -> bool:
+    global capvideo_calls
+    if capvideo_mode != "auto":
+        return capvideo_mode == "vbv"
+    capvideo_calls += 1
+    return vbv_accuracy >= vbv_min_accuracy or capvideo_calls % vbv_explore == 0
+
+
+def record_vbv(hit: bool):
+    global vbv_accuracy, vbv_samples
+    vbv_samples += 1
+    # as primeiras medidas pesam mais, depois a média esquece devagar
+    weight = max(1 / vbv_samples, .1)
+    vbv_accuracy += (hit - vbv_accuracy) * weight
+    logger.debug(f"precisão do vbv: {vbv_accuracy:.2f} em {vbv_samples} vídeos")
+
+
+async def vbvcapvideo(video, maxsize: int, duration: float, audio_bitrate: int):
+    """
+    codificação de uma passagem com CRF e VBV. o VBV limita a taxa em qualquer janela do tamanho do buffer, então o
+    vídeo fica abaixo de maxrate * (duração + buffer) e o CRF deixa vídeos fáceis ainda menores
+    """
+    # 2% para o contêiner
+    video_bits = maxsize * 8 * .98 - audio_bitrate * duration
+    # buffer de 1 segundo
+    maxrate = int(video_bits / (duration + 1))
+    if maxrate <= 0:
+        raise NonBugError("Não é possível ajustar o vídeo no Discord.")
+    logger.info(f"tentando forçar {video} sob {humanize.naturalsize(maxsize)} com vbv a "
+                f"{humanize.naturalsize(maxrate / 8)}/s")
+    outfile = reserve_tempfile("mp4")
+    await run_command('ffmpeg', '-i', video, '-c:v', 'h264', '-crf', '23', '-maxrate', str(maxrate), '-bufsize',
+                      str(maxrate), '-c:a', 'aac', '-b:a', str(audio_bitrate), "-f", "mp4", "-movflags", "+faststart",
+                      outfile)
+    return outfile
+
+
+async def twopassencode(video, maxsize: int, duration: float, audio_bitrate: int):
+    """
+    codificação de duas passagens. a primeira passagem só analisa o vídeo e as estatísticas servem para qualquer taxa da
+    segunda, então ela roda uma vez e só a segunda é repetida, com a taxa corrigida pelo tamanho que saiu
+    """
+    # https://trac.ffmpeg.org/wiki/Encode/H.264#twopass
+    # bytes to bits
+    target_video_bitrate = ((maxsize * 8) / duration - audio_bitrate) * .98
+    if target_video_bitrate <= 0:
+        raise NonBugError("Não é possível ajustar o vídeo no Discord.")
+    pass1log = utils.tempfiles.temp_file_name()
+    await run_command('ffmpeg', '-y', '-i', video, '-c:v', 'h264', '-b:v', str(target_video_bitrate), '-pass', '1',
+                      '-f', 'mp4', '-passlogfile', pass1log, 'NUL' if sys.platform == "win32" else "/dev/null")
+    # log files are pass1log-N.log and pass1log-N.log.mbtree where N is an int, easiest to just glob them all
+    for f in glob.glob(pass1log + "*"):
+        reserve_tempfile(f)
+    sizes = {}
+
+    async def pass2(bitrate):
+        logger.info(f"tentando forçar {video} sob {humanize.naturalsize(maxsize)} com duas passagens a "
+                    f"{humanize.naturalsize(bitrate / 8)}/s")
+        outfile = reserve_tempfile("mp4")
+        await run_command('ffmpeg', '-i', video, '-c:v', 'h264', '-b:v', str(bitrate), '-pass', '2',
+                          '-passlogfile', pass1log, '-c:a', 'aac', '-b:a', str(audio_bitrate), "-f", "mp4", "-movflags",
+                          "+faststart", outfile)
+        sizes[bitrate] = os.path.getsize(outfile)
+        logger.info(f"saída a {humanize.naturalsize(bitrate / 8)}/s é {humanize.naturalsize(sizes[bitrate])}")
+        return outfile
+
+    for _ in range(3):
+        # com a máquina ociosa, taxas menores rodam junto como reserva
+        candidates = [target_video_bitrate * step for step in candidate_steps[:spare_encoders()]]
+        if fit := await first_fit(pass2, candidates, maxsize):
+            logger.info(f"vídeo {humanize.naturalsize(sizes[fit[0]])} criado com sucesso!")
+            return fit[1]
+        # o erro medido diz quanto corrigir, em vez de uma lista fixa de tolerâncias
+        smallest = candidates[-1]
+        target_video_bitrate = smallest * maxsize / sizes[smallest] * .95
+    raise NonBugError(f"Não foi possível ajustar {video} dentro {humanize.naturalsize(maxsize)}")
+
+
 async def twopasscapvideo(video, maxsize: int, audio_bitrate=128000):
     """
-    tenta limitar de forma inteligente o tamanho do arquivo de vídeo com codificação de duas passagens
+    tenta limitar de forma inteligente o tamanho do arquivo de vídeo. usa uma passagem com vbv enquanto ela acertar o
+    tamanho com frequência suficiente, e duas passagens quando não acerta
 
     :param vídeo: arquivo de vídeo (caminho str)
     :param maxsize: tamanho máximo (em bytes) do arquivo de saída
     :param audio_bitrate: especifique opcionalmente uma taxa de bits de áudio em bits por segundo
     :return: novo arquivo de vídeo abaixo do tamanho máximo
     """
-    if (size := os.path.getsize(video)) < maxsize:
+    if os.path.getsize(video) < maxsize:
         return video
-    # https://trac.ffmpeg.org/wiki/Encode/H.264#twopass
     duration = await get_duration(video)
-    # bytes to bits
-    target_total_bitrate = (maxsize * 8) / duration
-    for tolerance in [.98, .95, .90, .75, .5]:
-        target_video_bitrate = (target_total_bitrate - audio_bitrate) * tolerance
-        if target_video_bitrate <= 0:
-            raise NonBugError("Não é possível ajustar o vídeo no Discord.")
-        logger.info(f"tentando forçar {video} ({humanize.naturalsize(size)}) "
-                    f"sob {humanize.naturalsize(maxsize)} com tolerância {tolerance}. "
-                    f"Tentando {humanize.naturalsize(target_video_bitrate / 8)}/s")
-        pass1log = utils.tempfiles.temp_file_name()
-        outfile = reserve_tempfile("mp4")
-        await run_command('ffmpeg', '-y', '-i', video, '-c:v', 'h264', '-b:v', str(target_video_bitrate), '-pass', '1',
-                          '-f', 'mp4', '-passlogfile', pass1log,
-                          'NUL' if sys.platform == "win32" else "/dev/null")
-        await run_command('ffmpeg', '-i', video, '-c:v', 'h264', '-b:v', str(target_video_bitrate), '-pass', '2',
-                          '-passlogfile', pass1log, '-c:a', 'aac', '-b:a', str(audio_bitrate), "-f", "mp4", "-movflags",
-                          "+faststart", outfile)
-        # log files are pass1log-N.log and pass1log-N.log.mbtree where N is an int, easiest to just glob them all
-        for f in glob.glob(pass1log + "*"):
-            reserve_tempfile(f)
-        if (size := os.path.getsize(outfile)) < maxsize:
-
+    if use_vbv():
+        outfile = await vbvcapvideo(video, maxsize, duration, audio_bitrate)
+        size = os.path.getsize(outfile)
+        if capvideo_mode == "auto":
+            record_vbv(size < maxsize)
+        if size < maxsize:
             logger.info(f"vídeo {humanize.naturalsize(size)} criado com sucesso!")
             return outfile
-        else:
-
-            logger.info(f"tolerância {tolerance} falhou. saída é {humanize.naturalsize(size)}")
-    raise NonBugError(f"Não foi possível ajustar {video} dentro {humanize.naturalsize(maxsize)}")
+        logger.info(f"vbv falhou. saída é {humanize.naturalsize(size)}")
+    return await twopassencode(video, maxsize, duration, audio_bitrate)
 
 
 async def intelligentdownsize(media, maxsize: int):
     """
-    tenta reduzir o tamanho da mídia de forma inteligente para caber no tamanho máximo
+    reduz a resolução da mídia para caber no tamanho máximo com uma única codificação final.
+    o tamanho é modelado como a * escala^k, ajustado com duas codificações de teste em resolução baixa (1/16 e 1/4 dos
+    pixels, baratas perto da final). se a previsão errar, faz no máximo uma correção.
 
     :param media: caminho de mídia str
     :param maxsize: tamanho máximo em bytes
     :return: novo arquivo de mídia abaixo do tamanho máximo
     """
-
-    size = os.path.getsize(media)
     w, h = await get_resolution(media)
-    for tolerance in [.98, .95, .90, .75, .5]:
-        reduction_ratio = (maxsize / size) * tolerance
-        # this took me longer to figure out than i am willing to admit
-        new_w = math.floor(math.sqrt(reduction_ratio * (w ** 2)))
-        new_h = math.floor(math.sqrt(reduction_ratio * (h ** 2)))
-        logger.info(f"trying to resize from {w}x{h} to {new_w}x{new_h} (~{reduction_ratio} reduction)")
+    # margem para a variação entre a previsão e a codificação real
+    target = maxsize * .95
+
+    # escala: (escala, arquivo, tamanho)
+    encoded = {}
+
+    async def encode(scale):
+        new_w, new_h = max(1, math.floor(w * scale)), max(1, math.floor(h * scale))
         resized = await resize(media, new_w, new_h, delete_orig=False)
-        if (size := os.path.getsize(resized)) < maxsize:
-            logger.info(f"successfully created {humanize.naturalsize(size)} media!")
-            return resized
+        if await mediatype(resized) == "GIF":
+            resized = await optimizegif(resized)
+        # a escala real, depois do arredondamento para pixels inteiros
+        encoded[scale] = new_w / w, resized, os.path.getsize(resized)
+        return resized
+
+    def predict(a, b):
+        # a e b são (escala, arquivo, tamanho)
+        if a[0] != b[0] and a[2] != b[2] and a[2] > 0 and b[2] > 0:
+            k = math.log(b[2] / a[2]) / math.log(b[0] / a[0])
+            # o tamanho cresce entre linear e quadrático com a escala, fora disso é ruído das codificações pequenas
+            k = min(max(k, 1), 2.5)
         else:
-            logger.info(f"tolerance {tolerance} failed. output is {humanize.naturalsize(size)}")
+            # dois pontos iguais (ex. ambos no mínimo de 1px) não formam uma curva, então usa o passo antigo: tamanho
+            # proporcional à área
+            k = 2
+        if b[2] <= 0:
+            return .99
+        return min(b[0] * (target / b[2]) ** (1 / k), .99)
+
+    await asyncio.gather(encode(.25), encode(.5))
+    trials = [encoded[.25], encoded[.5]]
+    scale = predict(*trials)
+    logger.info(f"modelo de tamanho: {[(t[0], humanize.naturalsize(t[2])) for t in trials]}, "
+                f"redimensionando {w}x{h} em {scale:.3f}x")
+    for attempt in range(2):
+        # com a máquina ociosa, escalas menores rodam junto como reserva. o tamanho cresce com a área, daí a raiz
+        candidates = [scale * step ** .5 for step in candidate_steps[:spare_encoders()]]
+        if fit := await first_fit(encode, candidates, maxsize):
+            logger.info(f"successfully created {humanize.naturalsize(encoded[fit[0]][2])} media!")
+            return fit[1]
+        if attempt == 0:
+            result = encoded[candidates[-1]]
+            logger.info(f"previsão {result[0]:.3f}x resultou em {humanize.naturalsize(result[2])}, corrigindo")
+            nearest = min(trials, key=lambda t: abs(t[0] - result[0]))
+            scale = min(predict(nearest, result), result[0] * .9)
+    # as codificações de teste ainda servem se couberem
+    if fits := [t for t in trials if t[2] < maxsize]:
+        return max(fits, key=lambda t: t[0])[1]
+    raise NonBugError(f"Não foi possível ajustar a mídia dentro de {humanize.naturalsize(maxsize)}")
 
 
 async def assurefilesize(media, re_encode=True):
@@ -178,6 +334,10 @@ async def assurefilesize(media, re_encode=True):
         raise NonBugError(f"O arquivo resultante é {humanize.naturalsize(size)}. "
                           f"Abortando o upload porque o arquivo resultante acabou "
                           f"{humanize.naturalsize(config.way_too_big_size)}")
+    if mt == "GIF" and size >= config.file_upload_limit:
+        # barato perto de redimensionar
+        media = await optimizegif(media, config.file_upload_limit)
+        size = os.path.getsize(media)
     if size < config.file_upload_limit:
         return media
     if mt == "VIDEO":
@@ -190,24 +350,110 @@ async def assurefilesize(media, re_encode=True):
         raise NonBugError(f"O arquivo é muito grande para carregar.")
 
 
+# cap fps because gifs are wackyyyyyy, then make and use nice palette
+gif_palette = "fps=fps='min(source_fps,50)'," \
+              "split[s0][s1];[s0]palettegen=reserve_transparent=1[p];[s1][p]paletteuse=bayer"
+
+
+gif_args = [
+    # prevent partial frames, makes filesize worse but fixes issues with transparency
+    "-gifflags", "-transdiff",
+    "-vf", gif_palette,
+    # i fucking hate gifs so much man
+    "-fps_mode", "vfr",
+]
+
+
 async def mp4togif(mp4):
     outname = reserve_tempfile("gif")
-    await run_command("ffmpeg", "-i", mp4,
-                      # prevent partial frames, makes filesize worse but fixes issues with transparency
-                      "-gifflags", "-transdiff",
-                      "-vf",
-                      # cap fps because gifs are wackyyyyyy
-                      "fps=fps='min(source_fps,50)',"
-                      # make and use nice palette
-                      "split[s0][s1];[s0]palettegen=reserve_transparent=1[p];[s1][p]paletteuse=bayer",
-                      # i fucking hate gifs so much man
-                      "-fps_mode", "vfr",
-                      outname)
+    await run_command("ffmpeg", "-i", mp4, *gif_args, outname)
 
     return outname
 
 
-async def reencode(mp4):  # reencodes mp4 as libx264 since the png format used cant be played by like literally anything
+# opcional, sem ele os gifs ficam como o ffmpeg gerou
+gifsicle = shutil.which("gifsicle")
+# (tamanho/alvo até o qual o nível costuma bastar, args do gifsicle), do mais leve ao mais agressivo
+gif_levels = [
+    # sem perdas: transparência entre quadros e recorte para o retângulo que mudou, que o -transdiff desliga
+    (1, []),
+    (1.4, ["--lossy=30"]),
+    (2, ["--lossy=80"]),
+    (3, ["--lossy=80", "--colors=128"]),
+    (math.inf, ["--lossy=200", "--colors=64"]),
+]
+
+
+async def optimizegif(gif, maxsize: int | None = None):
+    """
+    otimiza um gif com o gifsicle -O3. se passar de maxsize, escolhe o nível de compressão com perdas pelo tamanho
+    atual e tenta o próximo nível uma vez se ainda não couber
+
+    :param gif: gif
+    :param maxsize: tamanho alvo em bytes, ou None para só otimizar sem perdas
+    :return: o menor entre o gif original e os otimizados
+    """
+    if gifsicle is None:
+        return gif
+    ratio = os.path.getsize(gif) / maxsize if maxsize else 0
+    level = next(i for i, (limit, _) in enumerate(gif_levels) if ratio <= limit)
+    best = gif
+    for _, args in gif_levels[level:level + 2]:
+        outname = reserve_tempfile("gif")
+        await run_command(gifsicle, "-O3", "--no-warnings", *args, gif, "-o", outname)
+        logger.info(f"gifsicle {args}: {humanize.naturalsize(os.path.getsize(gif))} -> "
+                    f"{humanize.naturalsize(os.path.getsize(outname))}")
+        if os.path.getsize(outname) < os.path.getsize(best):
+            best = outname
+        if not maxsize or os.path.getsize(best) < maxsize:
+            break
+    return best
+
+
+async def run_lossless(mt: str, *args: str, source: list[str] | None = None) -> str:
+    """
+    roda um ffmpeg que escreveria um intermediário sem perdas, sem os intermediários que dá para evitar no temp dir:
+    para gifs, a saída vai por um pipe direto para a conversão de mp4togif(), e source (como o de forceaudio_input())
+    gera a entrada por outro pipe. todos os ffmpegs rodam juntos.
+    só liga as etapas dentro de um comando. entre as etapas de um chain que não são fundidas pelo processing.pipeline
+    ainda há um arquivo por etapa
+    :param mt: tipo de mídia da entrada, VIDEO, GIF ou IMAGE
+    :param args: args do ffmpeg, sem o codec de vídeo e o arquivo de saída. um -c:a aqui vale no lugar do áudio de
+        lossless(). com source, a entrada é "-f nut -i pipe:0"
+    :param source: comando que escreve a entrada em nut no stdout, ou None
+    :return: vídeo intermediário, gif ou png, de acordo com mt
+    """
+    commands = [source] if source is not None else []
+    if mt == "GIF":
+        outname = reserve_tempfile("gif")
+        await run_piped(*commands, ["ffmpeg", "-hide_banner", *args, *caller_audio(args, pipe_args), "pipe:1"],
+                        ["ffmpeg", "-hide_banner", "-f", "nut", "-i", "pipe:0", *gif_args, outname])
+        return outname
+    outname = reserve_tempfile("png" if mt == "IMAGE" else intermediate_ext)
+    command = ["ffmpeg", "-hide_banner", *args, *caller_audio(args, lossless(outname)), outname]
+    if commands:
+        await run_piped(*commands, command)
+    else:
+        await run_command(*command)
+    return outname
+
+
+def caller_audio(args: typing.Sequence[str], codec: list[str]) -> list[str]:
+    # os args do codec vêm depois dos de quem chamou (opções de saída ficam depois dos -i), então o áudio do codec
+    # sobrescreveria um "-c:a copy" de quem chamou. nesse caso, tira o áudio do codec
+    if "-c:a" not in args:
+        return codec
+    out = []
+    pairs = iter(codec)
+    for arg in pairs:
+        if arg in ["-c:a", "-q:a"]:
+            next(pairs)
+        else:
+            out.append(arg)
+    return out
+
+
+async def reencode(mp4):  # reencodes as libx264 since the lossless intermediates cant be played by anything
     assert (mt := await mediatype(mp4)) in ["VIDEO", "GIF"], f"file {mp4} with type {mt} passed to reencode()"
     # only reencode if need to ;)
     vcodec, acodec = await va_codecs(mp4)
@@ -291,17 +537,15 @@ async def speed(file, sp):
         await run_command("ffmpeg", "-hide_banner", "-i", file, "-filter_complex",
                           f"{expanded_atempo(sp)}", "-t", str(duration / float(sp)), "-c:a", "libmp3lame", outname)
     else:
-        outname = reserve_tempfile("mp4")
         fps = await get_frame_rate(file)
         duration = await get_duration(file)
-        await run_command("ffmpeg", "-hide_banner", "-i", await forceaudio(file), "-filter_complex",
-                          f"[0:v]setpts=PTS/{sp},fps={fps}[v];[0:a]{expanded_atempo(sp)}[a]",
-                          "-map", "[v]", "-map", "[a]", "-t", str(duration / float(sp)), "-c:v", "png", "-fps_mode",
-                          "vfr", outname)
+        inputs, source = await forceaudio_input(file)
+        outname = await run_lossless(mt, *inputs, "-filter_complex",
+                                     f"[0:v]setpts=PTS/{sp},fps={fps}[v];[0:a]{expanded_atempo(sp)}[a]",
+                                     "-map", "[v]", "-map", "[a]", "-t", str(duration / float(sp)), "-fps_mode", "vfr",
+                                     source=source)
         if await count_frames(outname) < 2:
             raise NonBugError("O arquivo de saída tem menos de 2 quadros. Tente reduzir a velocidade.")
-        if mt == "GIF":
-            outname = await mp4togif(outname)
 
     return outname
 
@@ -313,13 +557,8 @@ async def reverse(file):
     :return: mídia processada
     """
     mt = await mediatype(file)
-    outname = reserve_tempfile("mp4")
-    await run_command("ffmpeg", "-hide_banner", "-i", await forceaudio(file), "-vf", "reverse", "-af", "areverse",
-                      "-c:v", "png", "-fps_mode", "vfr", outname)
-
-    if mt == "GIF":
-        outname = await mp4togif(outname)
-    return outname
+    inputs, source = await forceaudio_input(file)
+    return await run_lossless(mt, *inputs, "-vf", "reverse", "-af", "areverse", "-fps_mode", "vfr", source=source)
 
 
 async def random(file, frames: int):
@@ -330,14 +569,7 @@ async def random(file, frames: int):
     :return: mídia processada
     """
     mt = await mediatype(file)
-    outname = reserve_tempfile("mp4")
-    #
-    await run_command("ffmpeg", "-hide_banner", "-i", file, "-filter:v", f"random=frames={frames}",
-                      "-c:v", "png", "-fps_mode", "vfr", outname)
-
-    if mt == "GIF":
-        outname = await mp4togif(outname)
-    return outname
+    return await run_lossless(mt, "-i", file, "-filter:v", f"random=frames={frames}", "-fps_mode", "vfr")
 
 
 async def quality(file, crf, qa):
@@ -367,13 +599,8 @@ async def changefps(file, fps):
     :return: mídia processada
     """
     mt = await mediatype(file)
-    outname = reserve_tempfile("mp4")
-    await run_command("ffmpeg", "-hide_banner", "-i", file, "-r", str(fps), "-c", "copy", "-c:v", "png", "-fps_mode",
-                      "vfr", outname)
-    if mt == "GIF":
-        outname = await mp4togif(outname)
-
-    return outname
+    # o -c:v de lossless() vem depois e vale para o vídeo, o áudio fica copiado
+    return await run_lossless(mt, "-i", file, "-r", str(fps), "-c", "copy", "-c:a", "copy", "-fps_mode", "vfr")
 
 
 async def invert(file):
@@ -383,18 +610,7 @@ async def invert(file):
     :return: mídia processada
     """
     mt = await mediatype(file)
-    exts = {
-        "VIDEO": "mp4",
-        "GIF": "mp4",
-        "IMAGE": "png"
-    }
-    outname = reserve_tempfile(exts[mt])
-    await run_command("ffmpeg", "-hide_banner", "-i", file, "-vf", f"negate", "-c:v", "png", "-fps_mode", "vfr",
-                      outname)
-
-    if mt == "GIF":
-        outname = await mp4togif(outname)
-    return outname
+    return await run_lossless(mt, "-i", file, "-vf", f"negate", "-fps_mode", "vfr")
 
 
 async def pad(file):
@@ -404,17 +620,9 @@ async def pad(file):
     :return: mídia processada
     """
     mt = await mediatype(file)
-    if mt == "IMAGE":
-        outname = reserve_tempfile("png")
-    else:
-        outname = reserve_tempfile("mp4")
-    await run_command("ffmpeg", "-hide_banner", "-i", file, "-vf",
-                      "pad=width='max(iw,ih)':height='max(iw,ih)':x='(ih-iw)/2':y='(iw-ih)/2':color=white", "-c:v",
-                      "png", "-fps_mode", "vfr", outname)
-
-    if mt == "GIF":
-        outname = await mp4togif(outname)
-    return outname
+    return await run_lossless(mt, "-i", file, "-vf",
+                              "pad=width='max(iw,ih)':height='max(iw,ih)':x='(ih-iw)/2':y='(iw-ih)/2':color=white",
+                              "-fps_mode", "vfr")
 
 
 async def gifloop(file, loop):
@@ -519,26 +727,26 @@ async def concatv(file0, file1):
     :return: vídeo combinado
     """
     video0 = await forceaudio(file0)
-    fixedvideo0 = reserve_tempfile("mp4")
-    await run_command("ffmpeg", "-hide_banner", "-i", video0, "-c:v", "png", "-c:a", "copy", "-ar", "48000",
+    fixedvideo0 = reserve_tempfile(intermediate_ext)
+    await run_command("ffmpeg", "-hide_banner", "-i", video0, *lossless(fixedvideo0), "-c:a", "copy", "-ar", "48000",
                       "-max_muxing_queue_size", "4096", "-fps_mode", "vfr", fixedvideo0)
     video1 = await forceaudio(file1)
     w, h = await get_resolution(video0)
     fps = await get_frame_rate(video0)
-    fixedvideo1 = reserve_tempfile("mp4")
+    fixedvideo1 = reserve_tempfile(intermediate_ext)
 
     # https://superuser.com/a/1136305/1001487
     await run_command("ffmpeg", "-hide_banner", "-i", video1, "-sws_flags",
                       "spline+accurate_rnd+full_chroma_int+full_chroma_inp", "-vf",
-                      f"scale={w}:{h}:force_original_aspect_ratio=decrease,pad={w}:{h}:-2:-2:color=black", "-c:v",
-                      "png", "-c:a", "copy", "-ar", "48000", "-fps_mode", "vfr", fixedvideo1)
+                      f"scale={w}:{h}:force_original_aspect_ratio=decrease,pad={w}:{h}:-2:-2:color=black",
+                      *lossless(fixedvideo1), "-c:a", "copy", "-ar", "48000", "-fps_mode", "vfr", fixedvideo1)
     fixedfixedvideo1 = await changefps(fixedvideo1, fps)
 
     concatdemuxer = reserve_tempfile("txt")
     with open(concatdemuxer, "w+") as f:
         f.write(f"file '{fixedvideo0}'\nfile '{fixedfixedvideo1}'")
-    outname = reserve_tempfile("mp4")
-    await run_command("ffmpeg", "-hide_banner", "-safe", "0", "-f", "concat", "-i", concatdemuxer, "-c:v", "png",
+    outname = reserve_tempfile(intermediate_ext)
+    await run_command("ffmpeg", "-hide_banner", "-safe", "0", "-f", "concat", "-i", concatdemuxer, *lossless(outname),
                       "-c:a", "copy", outname)
 
     if (await mediatype(file0)) == "GIF" and (await mediatype(file1)) == "GIF":
@@ -556,11 +764,11 @@ async def naive_vstack(file0, file1):
     if mts[0] == "IMAGE" and mts[1] == "IMAGE":
         return await processing.common.run_parallel(processing.vips.vipsutils.naive_stack, file0, file1)
     else:
-        out = reserve_tempfile("mp4")
+        out = reserve_tempfile(intermediate_ext)
         await run_command("ffmpeg", "-i", file0, "-i", file1, "-filter_complex",
                           "[0]format=pix_fmts=yuva420p[0f];"
                           "[1]format=pix_fmts=yuva420p[1f];"
-                          "[0f][1f]vstack=inputs=2", "-c:v", "png", "-fs", config.max_temp_file_size, "-fps_mode",
+                          "[0f][1f]vstack=inputs=2", *lossless(out), "-fs", config.max_temp_file_size, "-fps_mode",
                           "vfr", out)
 
         if "VIDEO" in mts:
@@ -586,7 +794,7 @@ async def stack(file0, file1, style):
         scaling_logic = "scale2ref=iw:ow/mdar"
 
     mixaudio = all(await asyncio.gather(hasaudio(file0), hasaudio(file1)))
-    outname = reserve_tempfile("mp4")
+    outname = reserve_tempfile(intermediate_ext)
     await run_command("ffmpeg", "-hide_banner", "-i", file0, "-i", file1,
                       "-filter_complex",
                       f"[0]setpts=PTS-STARTPTS,format=yuva420p[0v];"
@@ -597,7 +805,7 @@ async def stack(file0, file1, style):
                       f"[a][b]{'h' if style == 'hstack' else 'v'}stack=inputs=2" + \
                       # mix audio
                       (f";amix=inputs=2:dropout_transition=0" if mixaudio else ""),
-                      "-c:v", "png", "-c:a", "aac", "-q:a", "2", "-fps_mode", "vfr", outname)
+                      *lossless(outname), "-c:a", "aac", "-q:a", "2", "-fps_mode", "vfr", outname)
 
     # for file in [video0, video1, fixedvideo1, fixedvideo0, fixedfixedvideo1]:
     #     os.remove(file)
@@ -619,7 +827,7 @@ async def overlay(file0, file1, alpha: float, mode: str = 'overlay'):
     assert 0 <= alpha <= 1
     mts = [await mediatype(file0), await mediatype(file1)]
 
-    outname = reserve_tempfile("mp4")
+    outname = reserve_tempfile(intermediate_ext)
     blendlogic = ""
     if mode == "overlay":
         blendlogic = f"overlay"
@@ -640,7 +848,7 @@ async def overlay(file0, file1, alpha: float, mode: str = 'overlay'):
                       f"[a][b]{blendlogic}" + \
                       # mix audio
                       (f";amix=inputs=2:dropout_transition=0" if mixaudio else ""),
-                      "-c:v", "png", "-c:a", "aac", "-q:a", "2", "-fps_mode", "vfr", outname)
+                      *lossless(outname), "-c:a", "aac", "-q:a", "2", "-fps_mode", "vfr", outname)
 
     # for file in [video0, video1, fixedvideo1, fixedvideo0, fixedfixedvideo1]:
     #     os.remove(file)
@@ -661,20 +869,14 @@ async def trim(file, length, start=0):
     :return: mídia processada
     """
     mt = await mediatype(file)
-    exts = {
-        "AUDIO": "mp3",
-        "VIDEO": "mp4",
-        "GIF": "mp4"
-    }
     dur = await get_duration(file)
     if start > dur:
         raise NonBugError(f"Trim start ({start}s) is outside the range of the file ({dur}s)")
-    out = reserve_tempfile(exts[mt])
-    await run_command("ffmpeg", "-hide_banner", "-i", file, "-t", str(length), "-ss", str(start), "-c:v", "png",
+    if mt != "AUDIO":
+        return await run_lossless(mt, "-i", file, "-t", str(length), "-ss", str(start), "-fps_mode", "vfr")
+    out = reserve_tempfile("mp3")
+    await run_command("ffmpeg", "-hide_banner", "-i", file, "-t", str(length), "-ss", str(start), *lossless(out),
                       "-fps_mode", "vfr", out)
-
-    if mt == "GIF":
-        out = await mp4togif(out)
     return out
 
 
@@ -722,27 +924,18 @@ async def ensuresize(ctx, file, minsize, maxsize):
     return file
 
 
+rotate_types = {  # command input to ffmpeg vf
+    "90": "transpose=1",
+    "90ccw": "transpose=2",
+    "180": "vflip,hflip",
+    "vflip": "vflip",
+    "hflip": "hflip"
+}
+
+
 async def rotate(file, rottype):
-    types = {  # command input to ffmpeg vf
-        "90": "transpose=1",
-        "90ccw": "transpose=2",
-        "180": "vflip,hflip",
-        "vflip": "vflip",
-        "hflip": "hflip"
-    }
     mt = await mediatype(file)
-    exts = {
-        "VIDEO": "mp4",
-        "GIF": "mp4",
-        "IMAGE": "png"
-    }
-    out = reserve_tempfile(exts[mt])
-    await run_command("ffmpeg", "-i", file, "-vf", types[rottype] + ",format=yuva420p", "-c:v", "png", "-fps_mode",
-                      "vfr", out)
-
-    if mt == "GIF":
-        out = await mp4togif(out)
-    return out
+    return await run_lossless(mt, "-i", file, "-vf", rotate_types[rottype] + ",format=yuva420p", "-fps_mode", "vfr")
 
 
 async def volume(file, vol):
@@ -833,59 +1026,31 @@ async def resize(image, width, height, delete_orig=True):
     :return: mídia processada
     """
     mt = await mediatype(image)
-    exts = {
-        "AUDIO": "mp3",
-        "VIDEO": "mp4",
-        "GIF": "mp4",
-        "IMAGE": "png"
-    }
-    out = reserve_tempfile(exts[mt])
-    await run_command("ffmpeg", "-i", image, "-pix_fmt", "yuva420p", "-max_muxing_queue_size", "9999", "-sws_flags",
-                      "spline+accurate_rnd+full_chroma_int+full_chroma_inp+bitexact",
-                      "-vf", f"scale='{width}:{height}',setsar=1:1", "-c:v", "png", "-pix_fmt", "yuva420p", "-c:a",
-                      "copy", "-fps_mode", "vfr", out)
-
-
-    if mt == "GIF":
-        out = await mp4togif(out)
-    elif mt == "VIDEO":
+    out = await run_lossless(mt, "-i", image, "-max_muxing_queue_size", "9999", "-sws_flags",
+                             "spline+accurate_rnd+full_chroma_int+full_chroma_inp+bitexact",
+                             "-vf", f"scale='{width}:{height}',setsar=1:1", "-pix_fmt", "yuva420p", "-c:a", "copy",
+                             "-fps_mode", "vfr")
+    if mt == "VIDEO":
         out = await reencode(out)
     return out
 
 
 async def hue(file, h: float):
-    exts = {
-        "VIDEO": "mp4",
-        "GIF": "mp4",
-        "IMAGE": "png"
-    }
     mt = await mediatype(file)
-    out = reserve_tempfile(exts[mt])
-    await run_command("ffmpeg", "-i", file, "-vf", f"hue=h={h},format=yuva420p", "-c:v", "png", "-fps_mode", "vfr", out)
+    return await run_lossless(mt, "-i", file, "-vf", f"hue=h={h},format=yuva420p", "-fps_mode", "vfr")
 
-    if mt == "GIF":
-        out = await mp4togif(out)
-    return out
 
-
-async def tint(file, col: discord.Color):
-    exts = {
-        "VIDEO": "mp4",
-        "GIF": "mp4",
-        "IMAGE": "png"
-    }
-    mt = await mediatype(file)
-    out = reserve_tempfile(exts[mt])
+def tint_filter(col: discord.Color):
     # https://stackoverflow.com/a/3380739/9044183
     r, g, b = map(lambda x: x / 255, col.to_rgb())
-    await run_command("ffmpeg", "-i", file, "-vf",
-                      f"hue=s=0,"  # fazer tons de cinza
-                      f"lutrgb=r=val*{r}:g=val*{g}:b=val*{b}:a=val,"  # basicamente definir branco para a nossa cor 
-                      f"format=yuva420p", "-c:v", "png", "-fps_mode", "vfr", out)
+    return (f"hue=s=0,"  # fazer tons de cinza
+            f"lutrgb=r=val*{r}:g=val*{g}:b=val*{b}:a=val,"  # basicamente definir branco para a nossa cor
+            f"format=yuva420p")
 
-    if mt == "GIF":
-        out = await mp4togif(out)
-    return out
+
+async def tint(file, col: discord.Color):
+    mt = await mediatype(file)
+    return await run_lossless(mt, "-i", file, "-vf", tint_filter(col), "-fps_mode", "vfr")
 
 
 async def epicbirthday(text: str):
@@ -932,34 +1097,13 @@ async def epicbirthday(text: str):
 
 async def crop(file, w, h, x, y):
     mt = await mediatype(file)
-    exts = {
-        "VIDEO": "mp4",
-        "GIF": "mp4",
-        "IMAGE": "png"
-    }
-    outname = reserve_tempfile(exts[mt])
-    await run_command('ffmpeg', '-i', file, '-filter:v', f'crop={w}:{h}:{x}:{y}', "-c:v", "png", outname)
-    if mt == "GIF":
-        outname = await mp4togif(outname)
-
-    return outname
+    return await run_lossless(mt, '-i', file, '-filter:v', f'crop={w}:{h}:{x}:{y}')
 
 
 async def trim_top(file, trim_size):
     mt = await mediatype(file)
-    exts = {
-        "VIDEO": "mp4",
-        "GIF": "mp4",
-        "IMAGE": "png"
-    }
-    outname = reserve_tempfile(exts[mt])
-    await run_command('ffmpeg', '-i', file, '-filter:v', f'crop=out_h=ih-{trim_size}:y={trim_size}', "-c:v", "png",
-                      "-fps_mode", "vfr",
-                      outname)
-
-    if mt == "GIF":
-        outname = await mp4togif(outname)
-    return outname
+    return await run_lossless(mt, '-i', file, '-filter:v', f'crop=out_h=ih-{trim_size}:y={trim_size}',
+                              "-fps_mode", "vfr")
 
 
 async def toapng(video):
@@ -976,30 +1120,19 @@ async def motivate(media, captions: typing.Sequence[str]):
     text = await processing.common.run_parallel(processing.vips.caption.motivate_text, captions,
                                                 processing.vips.vipsutils.ImageSize(*await get_resolution(media)))
     mt = await mediatype(media)
-    exts = {
-        "VIDEO": "mp4",
-        "GIF": "mp4",
-        "IMAGE": "png"
-    }
-    outfile = reserve_tempfile(exts[mt])
-    await run_command("ffmpeg", "-i", media, "-i", text, "-filter_complex",
-                      "[0]pad=w=iw+(iw/60):h=ih+(iw/60):x=(iw/120):y=(iw/120):color=black[0p0];"
-                      "[0p0]pad=w=iw+(iw/30):h=ih+(iw/30):x=(iw/60):y=(iw/60):color=white[0p1];"
-                      "[0p1]pad=w=iw:h=ih+(iw/30):x=0:y=0[0p2];"
-                      "[0p2][1]vstack=inputs=2[s];"
-                      "[s]pad=w=iw+(iw/5):h=ih+(iw/10)+(iw/30):x=(iw/10):y=(iw/10):color=black",
-                      "-c:v", "png", "-c:a", "copy", "-fps_mode", "vfr",
-                      outfile)
-
-    if mt == "GIF":
-        outfile = await mp4togif(outfile)
-    return outfile
+    return await run_lossless(mt, "-i", media, "-i", text, "-filter_complex",
+                              "[0]pad=w=iw+(iw/60):h=ih+(iw/60):x=(iw/120):y=(iw/120):color=black[0p0];"
+                              "[0p0]pad=w=iw+(iw/30):h=ih+(iw/30):x=(iw/60):y=(iw/60):color=white[0p1];"
+                              "[0p1]pad=w=iw:h=ih+(iw/30):x=0:y=0[0p2];"
+                              "[0p2][1]vstack=inputs=2[s];"
+                              "[s]pad=w=iw+(iw/5):h=ih+(iw/10)+(iw/30):x=(iw/10):y=(iw/10):color=black",
+                              "-c:a", "copy", "-fps_mode", "vfr")
 
 
 async def naive_overlay(im1, im2):
     mts = [await mediatype(im1), await mediatype(im2)]
-    outname = reserve_tempfile("mp4")
-    await run_command("ffmpeg", "-i", im1, "-i", im2, "-filter_complex", "overlay", "-c:v", "png", "-fs",
+    outname = reserve_tempfile(intermediate_ext)
+    await run_command("ffmpeg", "-i", im1, "-i", im2, "-filter_complex", "overlay", *lossless(outname), "-fs",
                       config.max_temp_file_size, "-fps_mode", "vfr", outname)
     if mts[0] == "IMAGE" and mts[1] == "IMAGE":
         outname = await mediatopng(outname)
@@ -1029,24 +1162,27 @@ async def freezemotivate(video, *caption):
     return await freezemotivateaudio(video, "rendering/what.mp3", *caption)
 
 
+def round_corners_filter(border_radius):
+    # https://stackoverflow.com/a/62400465/9044183
+    return f"format=yuva420p," \
+           f"geq=lum='p(X,Y)':a='" \
+           f"if(gt(abs(W/2-X),W/2-{border_radius})*gt(abs(H/2-Y)," \
+           f"H/2-{border_radius})," \
+           f"if(lte(hypot({border_radius}-(W/2-abs(W/2-X))," \
+           f"{border_radius}-(H/2-abs(H/2-Y)))," \
+           f"{border_radius}),255,0),255)'"
+
+
 async def round_corners(media, border_radius=10):
     mt = await mediatype(media)
     exts = {
-        "VIDEO": "mp4",
-        "GIF": "mp4",
+        "VIDEO": intermediate_ext,
+        "GIF": intermediate_ext,
         "IMAGE": "png"
     }
     outfile = reserve_tempfile(exts[mt])
-    # https://stackoverflow.com/a/62400465/9044183
-    await run_command("ffmpeg", "-i", media, "-filter_complex",
-                      f"format=yuva420p,"
-                      f"geq=lum='p(X,Y)':a='"
-                      f"if(gt(abs(W/2-X),W/2-{border_radius})*gt(abs(H/2-Y),"
-                      f"H/2-{border_radius}),"
-                      f"if(lte(hypot({border_radius}-(W/2-abs(W/2-X)),"
-                      f"{border_radius}-(H/2-abs(H/2-Y))),"
-                      f"{border_radius}),255,0),255)'",
-                      "-c:v", "png", "-c:a", "copy", "-fps_mode", "vfr",
+    await run_command("ffmpeg", "-i", media, "-filter_complex", round_corners_filter(border_radius),
+                      *lossless(outfile), "-c:a", "copy", "-fps_mode", "vfr",
                       outfile)
 
     return outfile
@@ -1060,69 +1196,47 @@ async def twitter_caption(media, captions, dark=True):
     text = await processing.common.run_parallel(processing.vips.caption.twitter_text, captions,
                                                 processing.vips.vipsutils.ImageSize(width, height), dark)
     border_radius = width * (16 / 500)
-    exts = {
-        "VIDEO": "mp4",
-        "GIF": "mp4",
-        "IMAGE": "png"
-    }
-    outfile = reserve_tempfile(exts[mt])
-    await run_command("ffmpeg", "-i", media, "-i", text, "-filter_complex",
-                      # cantos arredondados
-                      # https://stackoverflow.com/a/62400465/9044183
-                      # copiado de round_corners aqui para eficiência como 1 fluxo ffmpeg
-                      f"[0]format=yuva420p,"
-                      f"geq=lum='p(X,Y)':a='"
-                      f"if(gt(abs(W/2-X),W/2-{border_radius})*gt(abs(H/2-Y),"
-                      f"H/2-{border_radius}),"
-                      f"if(lte(hypot({border_radius}-(W/2-abs(W/2-X)),"
-                      f"{border_radius}-(H/2-abs(H/2-Y))),"
-                      f"{border_radius}),255,0),255)'[media];"
-                      # adicionar preenchimento ao redor da mídia
-                      f"[media]pad=w=iw+(iw*(12/500)*2):"
-                      f"h=ih+(iw*(12/500)):"
-                      f"x=(iw*(12/500)):"
-                      f"y=0:color=#00000000[media];"
-                      # pilha
-                      f"[1][media]vstack=inputs=2[stacked];"
-                      # adicionar plano de fundo
-                      f"[stacked]split=2[bg][fg];"
-                      f"[bg]drawbox=c={'#15202b' if dark else '#ffffff'}:replace=1:t=fill[bg];"
-                      f"[bg][fg]overlay=format=auto",
-                      "-c:v", "png", "-c:a", "copy", "-fps_mode", "vfr",
-                      outfile)
-
-    if mt == "GIF":
-        outfile = await mp4togif(outfile)
-    return outfile
+    return await run_lossless(mt, "-i", media, "-i", text, "-filter_complex",
+                              # cantos arredondados
+                              # https://stackoverflow.com/a/62400465/9044183
+                              # copiado de round_corners aqui para eficiência como 1 fluxo ffmpeg
+                              f"[0]format=yuva420p,"
+                              f"geq=lum='p(X,Y)':a='"
+                              f"if(gt(abs(W/2-X),W/2-{border_radius})*gt(abs(H/2-Y),"
+                              f"H/2-{border_radius}),"
+                              f"if(lte(hypot({border_radius}-(W/2-abs(W/2-X)),"
+                              f"{border_radius}-(H/2-abs(H/2-Y))),"
+                              f"{border_radius}),255,0),255)'[media];"
+                              # adicionar preenchimento ao redor da mídia
+                              f"[media]pad=w=iw+(iw*(12/500)*2):"
+                              f"h=ih+(iw*(12/500)):"
+                              f"x=(iw*(12/500)):"
+                              f"y=0:color=#00000000[media];"
+                              # pilha
+                              f"[1][media]vstack=inputs=2[stacked];"
+                              # adicionar plano de fundo
+                              f"[stacked]split=2[bg][fg];"
+                              f"[bg]drawbox=c={'#15202b' if dark else '#ffffff'}:replace=1:t=fill[bg];"
+                              f"[bg][fg]overlay=format=auto",
+                              "-c:a", "copy", "-fps_mode", "vfr")
 
 
 async def trollface(media):
     mt = await mediatype(media)
-    exts = {
-        "VIDEO": "mp4",
-        "GIF": "mp4",
-        "IMAGE": "png"
-    }
-    outfile = reserve_tempfile(exts[mt])
-    await run_command("ffmpeg", "-i", media,
-                      "-i", "rendering/images/trollface/bottom.png",
-                      "-loop", "1", "-i", "rendering/images/trollface/mask.png",
-                      "-i", "rendering/images/trollface/top.png",
-                      "-filter_complex",
-                      # redimensionar mídia de entrada
-                      "[0]scale=500:407[media];"
-                      # mídia de entrada de máscara
-                      "[2:v]alphaextract[mask];"
-                      "[media][mask]alphamerge[media];"
-                      # sobreposição inferior e superior
-                      "[1:v][media]overlay[media];"
-                      "[media][3:v]overlay",
-                      "-c:v", "png", "-c:a", "copy", "-fps_mode", "vfr",
-                      outfile)
-
-    if mt == "GIF":
-        outfile = await mp4togif(outfile)
-    return outfile
+    return await run_lossless(mt, "-i", media,
+                              "-i", "rendering/images/trollface/bottom.png",
+                              "-loop", "1", "-i", "rendering/images/trollface/mask.png",
+                              "-i", "rendering/images/trollface/top.png",
+                              "-filter_complex",
+                              # redimensionar mídia de entrada
+                              "[0]scale=500:407[media];"
+                              # mídia de entrada de máscara
+                              "[2:v]alphaextract[mask];"
+                              "[media][mask]alphamerge[media];"
+                              # sobreposição inferior e superior
+                              "[1:v][media]overlay[media];"
+                              "[media][3:v]overlay",
+                              "-c:a", "copy", "-fps_mode", "vfr")
 
 
 def rgb_to_lightness(r, g, b):
@@ -1138,6 +1252,12 @@ def rgb_to_lightness(r, g, b):
     return (minc + maxc) / 2.0
 
 
+def deepfry_filter(brightness, contrast, sharpness, saturation, noise):
+    return f"eq=contrast={contrast}:brightness={brightness}:saturation={saturation}," \
+           f"unsharp=luma_msize_x=7:luma_msize_y=7:luma_amount={sharpness}," \
+           f"noise=alls={noise}"
+
+
 async def deepfry(media, brightness, contrast, sharpness, saturation, noise):
     mt = await mediatype(media)
     exts = {
@@ -1147,10 +1267,8 @@ async def deepfry(media, brightness, contrast, sharpness, saturation, noise):
     }
     outfile = reserve_tempfile(exts[mt])
 
-    await run_command("ffmpeg", "-i", media, "-vf",
-                      f"eq=contrast={contrast}:brightness={brightness}:saturation={saturation},"
-                      f"unsharp=luma_msize_x=7:luma_msize_y=7:luma_amount={sharpness},"
-                      f"noise=alls={noise}", "-fps_mode", "vfr", outfile)
+    await run_command("ffmpeg", "-i", media, "-vf", deepfry_filter(brightness, contrast, sharpness, saturation, noise),
+                      "-fps_mode", "vfr", outfile)
 
     if mt == "GIF":
         outfile = await mp4togif(outfile)
@@ -1,5 +1,9 @@
+import dataclasses
+import hashlib
 import json
 import sys
+import time
+
 import apng
 if sys.platform == "win32":  # espero que isso não cause nenhum problema :>
     from winmagic import magic
@@ -7,17 +11,291 @@ else:
     import magic
 from PIL import Image, UnidentifiedImageError
 
+import config
+from core import database
 from processing.common import *
+import utils.tempfiles
+
+
+@dataclasses.dataclass
+class MediaInfo:
+    """
+    resultado de uma única sondagem de um arquivo. memorizado por TempFileSession, veja probe()
+    """
+    mime: str
+    mediatype: str | None
+    streams: list[dict]
+    format: dict
+    is_apng: bool = False
+    width: int | None = None
+    height: int | None = None
+    fps: float | None = None
+    duration: float | None = None
+    vcodec: dict | None = None
+    acodec: dict | None = None
+    frame_count: int | None = None
+
+    @property
+    def has_audio(self):
+        return self.acodec is not None
+
+
+def apng_timing(filename):
+    """
+    analisa um apng manualmente, o ffmpeg não gosta deles
+    :param filename: nome do arquivo
+    :return: (número de quadros, duração em segundos)
+    """
+    parsedapng = apng.APNG.open(filename)
+    apnglen = 0
+    # https://wiki.mozilla.org/APNG_Specification#.60fcTL.60:_The_Frame_Control_Chunk
+    for png, control in parsedapng.frames:
+        if control.delay_den == 0:
+            control.delay_den = 100
+        apnglen += control.delay / control.delay_den
+    return len(parsedapng.frames), apnglen
+
+
+def pil_mediatype(filename):
+    # O ffmpeg não funciona bem com a detecção de imagens, então deixe o PIL fazer isso
+    try:
+        with Image.open(filename) as im:
+            anim = getattr(im, "is_animated", False)
+        # os gifs não precisam ser animados, mas se não forem, é mais fácil tratá-los como pngs
+        return "GIF" if anim else "IMAGE"
+    except UnidentifiedImageError:
+        logger.debug(f"UnidentifiedImageError ativado {filename}")
+        return None
+
+
+def streams_mediatype(streams: list[dict]):
+    props = {
+        "video": False,
+        "audio": False,
+        "gif": False,
+        "image": False
+    }
+    for stream in streams:
+        if stream["codec_type"] == "audio":  # só pode ser áudio puro
+            props["audio"] = True
+        elif stream["codec_type"] == "video":  # pode ser vídeo ou imagem ou gif infelizmente
+            if "nb_read_packets" in stream and int(stream["nb_read_packets"]) != 1:  # se houver vários quadros
+                if stream["codec_name"] == "gif":  # se gif
+                    # deveria ter sido detectado na etapa anterior, mas não custa nada ter certeza
+                    props["gif"] = True  # gif
+                else:  #vários quadros, não gif
+                    props["video"] = True  # video!!
+            else:  # se houver apenas um quadro
+                props["image"] = True  # é uma imagem
+                # sim, isso marcará 1 quadro/gifs não animados como imagens.
+                # este é um comportamento intencional, pois a maioria dos comandos trata os gifs como vídeos
+    # ok, então um container pode ter vários formatos, precisamos retornar com base na prioridade esperada
+    if props["video"]:
+        return "VIDEO"
+    if props["gif"]:
+        return "GIF"
+    if props["audio"]:
+        return "AUDIO"
+    if props["image"]:
+        return "IMAGE"
+    return None
+
+
+def parse_probe(filename, mime: str, pil_type: str | None, data: dict) -> MediaInfo:
+    """
+    transforma a saída json do ffprobe em um MediaInfo
+    """
+    streams = data.get("streams", [])
+    fmt = data.get("format", {})
+    info = MediaInfo(mime=mime, mediatype=pil_type or streams_mediatype(streams), streams=streams, format=fmt)
+    vstream = next((s for s in streams if s.get("codec_type") == "video"), None)
+    astream = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    if vstream is not None:
+        info.vcodec = {k: vstream[k] for k in ["codec_name", "codec_long_name"] if k in vstream}
+        info.is_apng = vstream.get("codec_name") == "apng"
+        w = vstream.get("width")
+        h = vstream.get("height")
+        # if girado em metadados, troca de largura e altura
+        if "rotate" in vstream.get("tags", {}):
+            rot = float(vstream["tags"]["rotate"])
+            if rot % 90 == 0 and not rot % 180 == 0:
+                w, h = h, w
+        info.width, info.height = w, h
+        if "nb_read_packets" in vstream:
+            info.frame_count = int(vstream["nb_read_packets"])
+        rate = vstream.get("r_frame_rate", "").split("/")
+        if len(rate) == 1 and rate[0]:
+            info.fps = float(rate[0])
+        elif len(rate) == 2 and float(rate[1]):
+            info.fps = float(rate[0]) / float(rate[1])
+        else:
+            info.fps = -1
+    if astream is not None:
+        info.acodec = {k: astream[k] for k in ["codec_name", "codec_long_name"] if k in astream}
+    if fmt.get("duration", "N/A") != "N/A":
+        info.duration = float(fmt["duration"])
+    if info.is_apng:  # ffmpeg no likey apng
+        frames, apnglen = apng_timing(filename)
+        info.fps = frames / apnglen
+        if info.duration is None:
+            info.duration = apnglen
+    return info
+
+
+# contadores do cache persistente de sondagens, exibidos pelo comando $probecache
+probe_cache_stats = {"hits": 0, "misses": 0}
+# número máximo de linhas do probe_cache, as usadas menos recentemente são removidas primeiro
+probe_cache_max_rows = config.probe_cache_rows if hasattr(config, "probe_cache_rows") else 10_000
+# hash -> last_used ainda não gravado, veja probe_cache_flush()
+probe_cache_touched: dict[str, float] = {}
+# hash -> (info em json, last_used) das sondagens novas ainda não gravadas
+probe_cache_new: dict[str, tuple[str, float]] = {}
+# linhas na tabela, contadas na primeira limpeza e mantidas depois
+probe_cache_rows: int | None = None
+probe_cache_flush_interval = 60
+probe_cache_flushed = time.monotonic()
+
+
+def content_hash(filename):
+    """
+    hash rápido do conteúdo de um arquivo, usado como chave do cache persistente de sondagens
+    :param filename: nome do arquivo
+    :return: hex digest
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+async def file_digest(filename) -> str:
+    """
+    content_hash() sem bloquear, memorizado pela TempFileSession da mesma forma que probe()
+    :param filename: nome do arquivo
+    :return: hex digest
+    """
+    stat = os.stat(filename)
+    key = ("digest", os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    try:
+        memo = utils.tempfiles.probes.get()
+    except LookupError:
+        memo = None
+    if memo is not None and key in memo:
+        return memo[key]
+    digest = await asyncio.to_thread(content_hash, filename)
+    if memo is not None:
+        memo[key] = digest
+    return digest
+
+
+async def probe_cache_flush():
+    """
+    grava as sondagens novas e os last_used pendentes e remove as linhas usadas menos recentemente se a tabela passou
+    do limite
+    """
+    global probe_cache_rows, probe_cache_flushed
+    db = getattr(database, "db", None)
+    if db is None:
+        return
+    probe_cache_flushed = time.monotonic()
+    if probe_cache_new:
+        rows = [(digest, info, last_used) for digest, (info, last_used) in probe_cache_new.items()]
+        probe_cache_new.clear()
+        await db.executemany("REPLACE INTO probe_cache(hash, info, last_used) VALUES (?,?,?)", rows)
+        if probe_cache_rows is not None:
+            # REPLACE de uma linha que já existia conta a mais, o que só adianta um pouco a próxima limpeza
+            probe_cache_rows += len(rows)
+    if probe_cache_touched:
+        rows = [(last_used, digest) for digest, last_used in probe_cache_touched.items()]
+        probe_cache_touched.clear()
+        await db.executemany("UPDATE probe_cache SET last_used=? WHERE hash=?", rows)
+    if probe_cache_rows is None:
+        async with db.execute("SELECT count(*) FROM probe_cache") as cur:
+            probe_cache_rows = (await cur.fetchone())[0]
+    if probe_cache_rows > probe_cache_max_rows:
+        await db.execute("DELETE FROM probe_cache WHERE hash NOT IN "
+                         "(SELECT hash FROM probe_cache ORDER BY last_used DESC LIMIT ?)", (probe_cache_max_rows,))
+        probe_cache_rows = probe_cache_max_rows
+    await db.commit()
+
+
+async def probe_cache_maybe_flush():
+    if time.monotonic() - probe_cache_flushed > probe_cache_flush_interval:
+        await probe_cache_flush()
+
+
+async def probe_cache_get(digest: str) -> MediaInfo | None:
+    db = getattr(database, "db", None)
+    if db is None:  # o banco de dados só existe no processo do bot
+        return None
+    if digest in probe_cache_new:
+        probe_cache_stats["hits"] += 1
+        return MediaInfo(**json.loads(probe_cache_new[digest][0]))
+    async with db.execute("SELECT info FROM probe_cache WHERE hash=?", (digest,)) as cur:
+        row = await cur.fetchone()
+    if row is None:
+        probe_cache_stats["misses"] += 1
+        return None
+    probe_cache_stats["hits"] += 1
+    # só na memória, gravado junto com os outros por probe_cache_flush()
+    probe_cache_touched[digest] = time.time()
+    await probe_cache_maybe_flush()
+    return MediaInfo(**json.loads(row[0]))
+
+
+async def probe_cache_put(digest: str, info: MediaInfo):
+    if getattr(database, "db", None) is None:
+        return
+    # só na memória, gravado junto com os outros por probe_cache_flush()
+    probe_cache_new[digest] = (json.dumps(dataclasses.asdict(info)), time.time())
+    probe_cache_touched.pop(digest, None)
+    await probe_cache_maybe_flush()
+
+
+async def probe(filename, persist=False) -> MediaInfo:
+    """
+    sonda um arquivo com uma única chamada ao ffprobe (mais o PIL/magic). o resultado é memorizado pelo resto da
+    TempFileSession atual, com chave de caminho+tamanho+mtime. com persist, também é guardado no banco de dados com
+    chave do hash do conteúdo, então a mesma mídia em outro comando não precisa de nenhum subprocesso.
+    :param filename: nome do arquivo de mídia
+    :param persist: usar o cache no banco de dados. só para as entradas baixadas, que se repetem entre comandos; os
+        arquivos intermediários não se repetem e só custariam o hash e uma linha na tabela
+    :return: MediaInfo
+    """
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    try:
+        memo = utils.tempfiles.probes.get()
+    except LookupError:  # fora de uma TempFileSession, nada para memorizar
+        memo = None
+    if memo is not None and key in memo:
+        return memo[key]
+    digest = await file_digest(filename) if persist else None
+    info = await probe_cache_get(digest) if persist else None
+    if info is None:
+        mime = magic.from_file(filename, mime=True)
+        pil_type = pil_mediatype(filename)
+        try:
+            out = await run_command("ffprobe", "-v", "panic", "-count_packets", "-show_streams", "-show_format",
+                                    "-print_format", "json", filename)
+            data = json.loads(out)
+        except CMDError:
+            # PIL já sabe o que é, não há problema se o ffprobe não souber
+            if pil_type is None:
+                raise
+            data = {}
+        info = parse_probe(filename, mime, pil_type, data)
+        if persist:
+            await probe_cache_put(digest, info)
+    logger.debug(f"tipo identificado {info.mime} como {info.mediatype}")
+    if memo is not None:
+        memo[key] = info
+    return info
 
 
 async def is_apng(filename):
-    out = await run_command("ffprobe", filename, "-v", "panic", "-select_streams", "v:0", "-print_format", "json",
-                            "-show_entries", "stream=codec_name")
-    data = json.loads(out)
-    if len(data["streams"]):  # 0 if audio file because it selects v:0, audio cannot be apng
-        return data["streams"][0]["codec_name"] == "apng"
-    else:
-        return False
+    return (await probe(filename)).is_apng
 
 
 # https://askubuntu.com/questions/110264/how-to-find-frames-per-second-of-any-video-file
@@ -28,25 +306,10 @@ async def get_frame_rate(filename):
     :return: FPS
     """
     logger.info("Getting FPS...")
-    out = await run_command("ffprobe", filename, "-v", "panic", "-select_streams", "v:0", "-print_format", "json",
-                            "-show_entries", "stream=r_frame_rate,codec_name")
-    data = json.loads(out)
-    if data["streams"][0]["codec_name"] == "apng":  # ffmpeg no likey apng
-        parsedapng = apng.APNG.open(filename)
-        apnglen = 0
-        # https://wiki.mozilla.org/APNG_Specification#.60fcTL.60:_The_Frame_Control_Chunk
-        for png, control in parsedapng.frames:
-            if control.delay_den == 0:
-                control.delay_den = 100
-            apnglen += control.delay / control.delay_den
-        return len(parsedapng.frames) / apnglen
-    else:
-        rate = data["streams"][0]["r_frame_rate"].split("/")
-        if len(rate) == 1:
-            return float(rate[0])
-        if len(rate) == 2:
-            return float(rate[0]) / float(rate[1])
-        return -1
+    info = await probe(filename)
+    if info.fps is None:
+        raise Exception(f"{filename} não tem fluxo de vídeo.")
+    return info.fps
 
 
 # https://superuser.com/questions/650291/how-to-get-video-duration-in-seconds
@@ -57,20 +320,10 @@ async def get_duration(filename):
     :return: duração
     """
     logger.info("Obtendo duração...")
-    out = await run_command("ffprobe", "-v", "panic", "-show_entries", "format=duration", "-of",
-                            "default=noprint_wrappers=1:nokey=1", filename)
-    if out == "N/A":  # acontece com APNGs
-        # não há garantia de que é um PNG aqui, mas não tenho outros planos, então quero abrir uma exceção
-        parsedapng = apng.APNG.open(filename)
-        apnglen = 0
-        # https://wiki.mozilla.org/APNG_Specification#.60fcTL.60:_The_Frame_Control_Chunk
-        for png, control in parsedapng.frames:
-            if control.delay_den == 0:
-                control.delay_den = 100
-            apnglen += control.delay / control.delay_den
-        return apnglen
-    else:
-        return float(out)
+    info = await probe(filename)
+    if info.duration is None:
+        raise Exception(f"Não foi possível determinar a duração de {filename}.")
+    return info.duration
 
 
 async def get_resolution(filename):
@@ -79,19 +332,10 @@ async def get_resolution(filename):
     :param filename: nome do arquivo
     :return: [largura altura]
     """
-    out = await run_command("ffprobe", "-v", "panic", "-select_streams", "v:0", "-show_entries",
-                            "stream=width,height:stream_tags=rotate",
-                            "-print_format", "json", filename)
-    out = json.loads(out)
-    w = out["streams"][0]["width"]
-    h = out["streams"][0]["height"]
-    # if girado em metadados, troca de largura e altura
-    if "tags" in out["streams"][0]:
-        if "rotate" in out["streams"][0]["tags"]:
-            rot = float(out["streams"][0]["tags"]["rotate"])
-            if rot % 90 == 0 and not rot % 180 == 0:
-                w, h = h, w
-    return [w, h]
+    info = await probe(filename)
+    if info.width is None or info.height is None:
+        raise Exception(f"{filename} não tem fluxo de vídeo.")
+    return [info.width, info.height]
 
 
 async def get_vcodec(filename):
@@ -100,15 +344,8 @@ async def get_vcodec(filename):
     :param filename: nome do arquivo
     :return: ditado contendo "codec_name" and "codec_long_name"
     """
-    out = await run_command("ffprobe", "-v", "panic", "-select_streams", "v:0", "-show_entries",
-                            "stream=codec_name,codec_long_name",
-                            "-print_format", "json", filename)
-    out = json.loads(out)
-    if out["streams"]:
-        return out["streams"][0]
-    else:
-        # verifica apenas o codec de vídeo, os arquivos de áudio retornam Nothing
-        return None
+    # verifica apenas o codec de vídeo, os arquivos de áudio retornam Nothing
+    return (await probe(filename)).vcodec
 
 
 async def get_acodec(filename):
@@ -117,29 +354,13 @@ async def get_acodec(filename):
     :param filename: nome do arquivo
     :return: ditado contendo "codec_name" e "codec_long_name"
     """
-    out = await run_command("ffprobe", "-v", "panic", "-select_streams", "a:0", "-show_entries",
-                            "stream=codec_name,codec_long_name",
-                            "-print_format", "json", filename)
-    out = json.loads(out)
-    if out["streams"]:
-        return out["streams"][0]
-    else:
-        return None
+    return (await probe(filename)).acodec
 
 
 async def va_codecs(filename):
-    out = await run_command('ffprobe', '-v', 'panic', '-show_entries', 'stream=codec_name,codec_type', '-print_format',
-                            'json', filename)
-    out = json.loads(out)
-    acodec = None
-    vcodec = None
-    if out["streams"]:
-        for stream in out["streams"]:
-            if stream["codec_type"] == "video" and vcodec is None:
-                vcodec = stream["codec_name"]
-            elif stream["codec_type"] == "audio" and acodec is None:
-                acodec = stream["codec_name"]
-        return vcodec, acodec
+    info = await probe(filename)
+    if info.streams:
+        return (info.vcodec or {}).get("codec_name"), (info.acodec or {}).get("codec_name")
     else:
         return None
 
@@ -150,55 +371,10 @@ async def mediatype(image):
     :param image: nome do arquivo de mídia
     :return: pode ser VÍDEO, ÁUDIO, GIF, IMAGEM ou Nenhum (inválido ou outro).
     """
-    # O ffmpeg não funciona bem com a detecção de imagens, então deixe o PIL fazer isso
-    mime = magic.from_file(image, mime=True)
-    try:
-        with Image.open(image) as im:
-            anim = getattr(im, "is_animated", False)
-        if anim:
-            logger.debug(f"tipo identificado {mime} com quadros animados como GIF")
-            return "GIF"  # os gifs não precisam ser animados, mas se não forem, é mais fácil tratá-los como pngs
-        else:
-            logger.debug(f"tipo identificado {mime} sem quadros animados como IMAGE")
-            return "IMAGE"
-    except UnidentifiedImageError:
-        logger.debug(f"UnidentifiedImageError ativado {image}")
-    # PIL não tem certeza, então deixe o ffmpeg assumir o controle
-    probe = await run_command('ffprobe', '-v', 'panic', '-count_packets', '-show_entries',
-                              'stream=codec_type,codec_name,nb_read_packets',
-                              '-print_format', 'json', image)
-    props = {
-        "video": False,
-        "audio": False,
-        "gif": False,
-        "image": False
-    }
-    probe = json.loads(probe)
-    for stream in probe["streams"]:
-        if stream["codec_type"] == "audio":  # só pode ser áudio puro
-            props["audio"] = True
-        elif stream["codec_type"] == "video":  # pode ser vídeo ou imagem ou gif infelizmente
-            if "nb_read_packets" in stream and int(stream["nb_read_packets"]) != 1:  # se houver vários quadros
-                if stream["codec_name"] == "gif":  # se gif
-                    # deveria ter sido detectado na etapa anterior, mas não custa nada ter certeza
-                    props["gif"] = True  # gif
-                else:  #vários quadros, não gif
-                    props["video"] = True  # video!!
-            else:  # se houver apenas um quadro
-                props["image"] = True  # é uma imagem
-                # sim, isso marcará 1 quadro/gifs não animados como imagens.
-                # este é um comportamento intencional, pois a maioria dos comandos trata os gifs como vídeos
-    # ok, então um container pode ter vários formatos, precisamos retornar com base na prioridade esperada
-    if props["video"]:
-        return "VIDEO"
-    if props["gif"]:
-        return "GIF"
-    if props["audio"]:
-        return "AUDIO"
-    if props["image"]:
-        return "IMAGE"
-    logger.debug(f"mediatype Nenhum devido ao tipo não classificado {mime}")
-    return None
+    info = await probe(image)
+    if info.mediatype is None:
+        logger.debug(f"mediatype Nenhum devido ao tipo não classificado {info.mime}")
+    return info.mediatype
 
 
 async def ffprobe(file):
@@ -208,8 +384,10 @@ async def ffprobe(file):
 
 async def count_frames(video):
     # https://stackoverflow.com/a/28376817/9044183
-    return int(await run_command("ffprobe", "-v", "error", "-select_streams", "v:0", "-count_packets", "-show_entries",
-                                 "stream=nb_read_packets", "-of", "csv=p=0", video))
+    info = await probe(video)
+    if info.frame_count is None:
+        raise Exception(f"{video} não tem fluxo de vídeo.")
+    return info.frame_count
 
 
 async def frame_n(video, n: int):
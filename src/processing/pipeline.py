@@ -0,0 +1,241 @@
+"""
+fusão de grafos de filtros: as etapas de um comando descrevem seus filtros do ffmpeg e o planejador junta as etapas
+consecutivas que podem ser fundidas em uma única execução do ffmpeg, escrevendo a saída final (h264/gif/png) direto
+em vez de um intermediário por etapa.
+"""
+import dataclasses
+import typing
+
+from discord.ext import commands
+
+import config
+import processing.ffmpeg
+from core.clogs import logger
+from processing.common import run_command
+from processing.ffprobe import MediaInfo, mediatype, probe
+from utils.tempfiles import reserve_tempfile
+
+
+@dataclasses.dataclass
+class Filter:
+    """
+    etapa que pode ser fundida: um fragmento de filtro de vídeo e/ou de áudio, cada um com uma entrada e uma saída
+    """
+    vf: str | None = None
+    af: str | None = None
+
+
+@dataclasses.dataclass
+class Call:
+    """
+    etapa que não pode ser fundida, roda await func(arquivo, *args, **kwargs) como sempre
+    """
+    func: typing.Callable
+    args: tuple = ()
+    kwargs: dict = dataclasses.field(default_factory=dict)
+
+
+Stage = Filter | Call
+
+# os mesmos de processing.ffmpeg.resize()
+sws_flags = "spline+accurate_rnd+full_chroma_int+full_chroma_inp+bitexact"
+
+# funções de processing.ffmpeg que são só um filtro de uma entrada, e a etapa equivalente com os mesmos args
+filters: dict[typing.Callable, typing.Callable[..., Filter]] = {
+    processing.ffmpeg.hue: lambda h: Filter(vf=f"hue=h={h},format=yuva420p"),
+    processing.ffmpeg.tint: lambda col: Filter(vf=processing.ffmpeg.tint_filter(col)),
+    processing.ffmpeg.invert: lambda: Filter(vf="negate"),
+    processing.ffmpeg.reverse: lambda: Filter(vf="reverse", af="areverse"),
+    processing.ffmpeg.rotate: lambda rottype: Filter(vf=processing.ffmpeg.rotate_types[rottype] + ",format=yuva420p"),
+    processing.ffmpeg.pad: lambda: Filter(
+        vf="pad=width='max(iw,ih)':height='max(iw,ih)':x='(ih-iw)/2':y='(iw-ih)/2':color=white"),
+    processing.ffmpeg.round_corners: lambda border_radius=10: Filter(
+        vf=processing.ffmpeg.round_corners_filter(border_radius)),
+    processing.ffmpeg.deepfry: lambda *args: Filter(vf=processing.ffmpeg.deepfry_filter(*args)),
+}
+# etapas que só o chain funde. como comandos sozinhos, changefps usa -r e resize tem o próprio scale, então process()
+# continua rodando os dois como antes
+chain_filters: dict[typing.Callable, typing.Callable[..., Filter]] = {
+    **filters,
+    processing.ffmpeg.changefps: lambda fps: Filter(vf=f"fps={fps}"),
+    processing.ffmpeg.resize: lambda width, height, delete_orig=True: Filter(
+        vf=f"scale='{width}:{height}':flags={sws_flags},setsar=1:1,format=yuva420p"),
+}
+
+
+def fusible(func: typing.Callable) -> bool:
+    return func in filters
+
+
+def plan(stages: list[Stage]) -> list[list[Filter] | Call]:
+    """
+    agrupa etapas Filter consecutivas
+    :param stages: etapas na ordem
+    :return: grupos de filtros para fundir em uma execução do ffmpeg, intercalados com as chamadas que sobraram
+    """
+    groups = []
+    for stage in stages:
+        if isinstance(stage, Call):
+            groups.append(stage)
+        elif groups and isinstance(groups[-1], list):
+            groups[-1].append(stage)
+        else:
+            groups.append([stage])
+    return groups
+
+
+async def fuse(file: str, group: list[Filter], output: str | None = None) -> str:
+    """
+    roda várias etapas Filter em uma única execução do ffmpeg
+    :param file: mídia de entrada
+    :param group: etapas para fundir, na ordem
+    :param output: "VIDEO" (h264, como reencode()), "GIF" (como mp4togif()), "IMAGE" (png) ou None para um
+        intermediário sem perdas (png para imagens)
+    :return: mídia processada
+    """
+    info = await probe(file)
+    vf = [f.vf for f in group if f.vf]
+    af = [f.af for f in group if f.af]
+    if output == "VIDEO":
+        out = reserve_tempfile("mp4")
+        vf.append("scale=ceil(iw/2)*2:ceil(ih/2)*2")
+        codec = ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-movflags", "+faststart"]
+    elif output == "GIF":
+        out = reserve_tempfile("gif")
+        vf.append(processing.ffmpeg.gif_palette)
+        codec = ["-gifflags", "-transdiff"]
+    elif output == "IMAGE" or (output is None and info.mediatype == "IMAGE"):
+        # imagens continuam em png mesmo no meio do caminho, o libvips não lê os intermediários de vídeo
+        out = reserve_tempfile("png")
+        codec = ["-frames:v", "1", "-c:v", "png"]
+    else:
+        out = reserve_tempfile(processing.ffmpeg.intermediate_ext)
+        codec = processing.ffmpeg.lossless(out)
+    graph = f"[0:v]{','.join(vf) or 'null'}[v]"
+    maps = ["-map", "[v]"]
+    # gif e png não têm áudio
+    if info.has_audio and output not in ["GIF", "IMAGE"]:
+        if af:
+            graph += f";[0:a]{','.join(af)}[a]"
+            maps += ["-map", "[a]"]
+        else:
+            maps += ["-map", "0:a"]
+        if not af and (output is None or info.acodec.get("codec_name") == "aac"):
+            codec += ["-c:a", "copy"]
+        else:
+            codec += ["-c:a", "aac", "-q:a", "2"]
+    logger.debug(f"fundindo {len(group)} etapas: {graph}")
+    await run_command("ffmpeg", "-hide_banner", "-i", file, "-filter_complex", graph, *maps, *codec,
+                      "-max_muxing_queue_size", "9999", "-fps_mode", "vfr", out)
+    return out
+
+
+async def finish(file: str, output: str | None) -> str:
+    # depois de uma Call, a mídia pode ainda estar em um intermediário
+    if output == "VIDEO":
+        return await processing.ffmpeg.reencode(file)
+    if output == "GIF" and await mediatype(file) != "GIF":
+        return await processing.ffmpeg.mp4togif(file)
+    if output == "IMAGE" and await mediatype(file) != "IMAGE":
+        return await processing.ffmpeg.mediatopng(file)
+    return file
+
+
+async def run(file: str, stages: list[Stage], output: str | None = None) -> str:
+    """
+    executa as etapas, fundindo as que puderem
+    :param file: mídia de entrada
+    :param stages: etapas na ordem
+    :param output: tipo da saída final, veja fuse()
+    :return: mídia processada
+    """
+    groups = plan(stages)
+    if not groups:
+        return await finish(file, output)
+    for i, group in enumerate(groups):
+        last = i == len(groups) - 1
+        if isinstance(group, Call):
+            file = await group.func(file, *group.args, **group.kwargs)
+            if last:
+                file = await finish(file, output)
+        else:
+            file = await fuse(file, group, output if last else None)
+    return file
+
+
+def scale_filter(w: int, h: int) -> Filter:
+    return Filter(vf=f"scale={w}:{h}:flags={sws_flags},setsar=1:1")
+
+
+async def size_stage(ctx: commands.Context, info: MediaInfo, minsize: int, maxsize: int) -> Filter | None:
+    """
+    o mesmo que processing.ffmpeg.ensuresize(), mas calcula a resolução final e devolve um único scale
+    :return: etapa de redimensionamento, ou None se a mídia já estiver dentro dos limites
+    """
+    if info.mediatype not in ["IMAGE", "VIDEO", "GIF"]:
+        return None
+    w, h = owidth, oheight = info.width, info.height
+    # scale com -1 mantém a proporção, arredondando. o outro lado do aumento fica em até maxsize * 2, como o
+    # min(-1, maxsize * 2) de ensuresize, para que uma entrada de 1x1000 não vire 200x200000
+    if w < minsize:
+        w, h = minsize, max(min(round(h * minsize / w), maxsize * 2), 1)
+    if h < minsize:
+        w, h = max(min(round(w * minsize / h), maxsize * 2), 1), minsize
+    if not await ctx.bot.is_owner(ctx.author):
+        if w > maxsize:
+            w, h = maxsize, max(round(h * maxsize / w), 1)
+        if h > maxsize:
+            w, h = max(round(w * maxsize / h), 1), maxsize
+    if (w, h) == (owidth, oheight):
+        return None
+    logger.info(f"Redimensionado de {owidth}x{oheight} para {w}x{h}")
+    await ctx.reply(f"Mídia de entrada redimensionada de {int(owidth)}x{int(oheight)} para {int(w)}x{int(h)}.",
+                    delete_after=5, mention_author=False)
+    return scale_filter(w, h)
+
+
+async def duration_stages(ctx: commands.Context, info: MediaInfo) -> list[Filter]:
+    """
+    o mesmo que processing.ffmpeg.ensureduration(), como filtros
+    :return: etapas para limitar o fps e cortar em config.max_frames
+    """
+    if info.mediatype != "VIDEO" or await ctx.bot.is_owner(ctx.author):
+        return []
+    stages = []
+    fps = info.fps
+    max_fps = config.max_fps if hasattr(config, "max_fps") else None
+    if max_fps is not None and fps > max_fps:
+        logger.debug(f"Capping FPS from {fps} to {max_fps}")
+        stages.append(Filter(vf=f"fps={max_fps}"))
+        fps = max_fps
+    max_frames = config.max_frames if hasattr(config, "max_frames") else None
+    frames = int(fps * (info.duration or 0))
+    if max_frames is not None and frames > max_frames:
+        newdur = max_frames / fps
+        tmsg = f"{config.emojis['warning']} arquivo de entrada é muito longo (~{frames} frames)! " \
+               f"Corte para {round(newdur, 1)}s (~{max_frames} quadros)."
+        logger.debug(tmsg)
+        await ctx.reply(tmsg, delete_after=5)
+        stages.append(Filter(vf=f"trim=duration={newdur},setpts=PTS-STARTPTS",
+                             af=f"atrim=duration={newdur},asetpts=PTS-STARTPTS"))
+    return stages
+
+
+async def fused_command(ctx: commands.Context, file: str, func: typing.Callable, *args, resize=True, **kwargs):
+    """
+    ensuresize → ensureduration → func → reencode/mp4togif → assurefilesize, em uma única execução do ffmpeg
+    :param ctx: discord context
+    :param file: mídia de entrada, já baixada
+    :param func: função de processing.ffmpeg registrada em filters
+    :param args: args de func
+    :param resize: o mesmo de process()
+    :return: mídia processada, pronta para enviar
+    """
+    info = await probe(file)
+    stages = []
+    if resize and (stage := await size_stage(ctx, info, config.min_size, config.max_size)):
+        stages.append(stage)
+    stages += await duration_stages(ctx, info)
+    stages.append(filters[func](*args, **kwargs))
+    result = await run(file, stages, info.mediatype)
+    return await processing.ffmpeg.assurefilesize(result)
@@ -3,28 +3,25 @@ import typing
 
 import pyvips
 
+from processing.common import nogil
 from processing.vips.vipsutils import ImageSize, escape, outline, overlay_in_middle
 from utils.tempfiles import reserve_tempfile
-from processing.vips.vipsutils import normalize
-
-twemoji = "rendering/fonts/TwemojiCOLR0.otf"
+from processing.vips.vipsutils import cached_render, normalize
 
 
+@nogil
+@cached_render
 def esmcaption(captions: typing.Sequence[str], size: ImageSize):
     captions = escape(captions)
     # https://github.com/esmBot/esmBot/blob/121615df63bdcff8ee42330d8a67a33a18bb463b/natives/caption.cc#L28-L50
     # constantes usadas pelo esmbot
     fontsize = size.width / 10
     textwidth = size.width * .92
-    # tecnicamente redundante, mas adiciona fonte twemoji
-    # NÃO FUNCIONA NO WINDOWS IDK PORQUE
-    out = pyvips.Image.text(".", fontfile=twemoji)
     # generate text
     out = pyvips.Image.text(
         captions[0],
         font=f"Twemoji Color Emoji,FuturaExtraBlackCondensed {fontsize}px",
         rgba=True,
-        fontfile="rendering/fonts/caption.otf",
         align=pyvips.Align.CENTRE,
         width=textwidth
     )
@@ -39,21 +36,19 @@ def esmcaption(captions: typing.Sequence[str], size: ImageSize):
     return outfile
 
 
+@nogil
+@cached_render
 def mediaforge_caption(captions: typing.Sequence[str], size: ImageSize):
     captions = escape(captions)
     # https://github.com/esmBot/esmBot/blob/121615df63bdcff8ee42330d8a67a33a18bb463b/natives/caption.cc#L28-L50
     # constantes usadas pelo esmbot
     fontsize = size.width / 10
     textwidth = size.width * .92
-    # tecnicamente redundante, mas adiciona fonte twemoji
-    # NÃO FUNCIONA NO WINDOWS IDK PORQUE
-    out = pyvips.Image.text(".", fontfile=twemoji)
     # gerar texto
     out = pyvips.Image.text(
         captions[0],
         font=f"Twemoji Color Emoji, Atkinson Hyperlegible Bold {fontsize}px",
         rgba=True,
-        fontfile="rendering/fonts/AtkinsonHyperlegible-Bold.ttf",
         align=pyvips.Align.CENTRE,
         width=textwidth
     )
@@ -68,6 +63,8 @@ def mediaforge_caption(captions: typing.Sequence[str], size: ImageSize):
     return outfile
 
 
+@nogil
+@cached_render
 def motivate_text(captions: typing.Sequence[str], size: ImageSize):
     captions = escape(captions)
     textsize = size.width / 5
@@ -76,28 +73,22 @@ def motivate_text(captions: typing.Sequence[str], size: ImageSize):
     toptext = None
     bottomtext = None
     if captions[0]:
-        # tecnicamente redundante, mas adiciona fonte twemoji
-        toptext = pyvips.Image.text(".", fontfile=twemoji)
         # gerar texto
         toptext = pyvips.Image.text(
             f"<span foreground=\"white\">{captions[0]}</span>",
             font=f"Twemoji Color Emoji,TimesNewRoman {textsize}px",
             rgba=True,
-            fontfile="rendering/fonts/times new roman.ttf",
             align=pyvips.Align.CENTRE,
             width=width
         )
         toptext = toptext.gravity(pyvips.CompassDirection.CENTRE, toptext.width, toptext.height + (textsize / 4),
                                   extend=pyvips.Extend.BLACK)
     if captions[1]:
-        # tecnicamente redundante, mas adiciona fonte twemoji
-        bottomtext = pyvips.Image.text(".", fontfile=twemoji)
         # gerar texto
         bottomtext = pyvips.Image.text(
             f"<span foreground=\"white\">{captions[1]}</span>",
             font=f"Twemoji Color Emoji,TimesNewRoman {int(textsize * 0.4)}px",
             rgba=True,
-            fontfile="rendering/fonts/times new roman.ttf",
             align=pyvips.Align.CENTRE,
             width=width
         )
@@ -125,6 +116,8 @@ def motivate_text(captions: typing.Sequence[str], size: ImageSize):
     return outfile
 
 
+@nogil
+@cached_render
 def meme(captions: typing.Sequence[str], size: ImageSize):
     captions = escape(captions)
     # imagem em branco
@@ -132,14 +125,11 @@ def meme(captions: typing.Sequence[str], size: ImageSize):
         interpretation=pyvips.enums.Interpretation.SRGB)
 
     if captions[0]:
-        # tecnicamente redundante, mas adiciona fonte twemoji
-        toptext = pyvips.Image.text(".", fontfile=twemoji)
         # gerar texto
         toptext = pyvips.Image.text(
             f"<span foreground=\"white\">{captions[0].upper()}</span>",
             font=f"Twemoji Color Emoji,ImpactMix",
             rgba=True,
-            fontfile="rendering/fonts/ImpactMix.ttf",
             align=pyvips.Align.CENTRE,
             width=int(size.width * .95),
             height=int((size.height * .95) / 3)
@@ -148,14 +138,11 @@ def meme(captions: typing.Sequence[str], size: ImageSize):
                                      x=((size.width - toptext.width) / 2),
                                      y=int(size.height * .025))
     if captions[1]:
-        # tecnicamente redundante, mas adiciona fonte twemoji
-        bottomtext = pyvips.Image.text(".", fontfile=twemoji)
         # gerar texto
         bottomtext = pyvips.Image.text(
             f"<span foreground=\"white\">{captions[1].upper()}</span>",
             font=f"Twemoji Color Emoji,ImpactMix",
             rgba=True,
-            fontfile="rendering/fonts/ImpactMix.ttf",
             align=pyvips.Align.CENTRE,
             width=int(size.width * .95),
             height=int((size.height * .95) / 3)
@@ -170,6 +157,8 @@ def meme(captions: typing.Sequence[str], size: ImageSize):
     return outfile
 
 
+@nogil
+@cached_render
 def tenor(captions: typing.Sequence[str], size: ImageSize):
     captions = escape(captions)
     # imagem em branco
@@ -177,14 +166,11 @@ def tenor(captions: typing.Sequence[str], size: ImageSize):
         interpretation=pyvips.enums.Interpretation.SRGB)
     textsize = size.width // 10
     if captions[0]:
-        # tecnicamente redundante, mas adiciona fonte twemoji
-        toptext = pyvips.Image.text(".", fontfile=twemoji)
         # gerar texto
         toptext = pyvips.Image.text(
             f"<span foreground=\"white\">{captions[0]}</span>",
             font=f"Twemoji Color Emoji,Ubuntu {textsize}px",
             rgba=True,
-            fontfile="rendering/fonts/Ubuntu-R.ttf",
             align=pyvips.Align.CENTRE,
             width=int(size.width * .95),
             height=int((size.height * .95) / 3)
@@ -193,14 +179,11 @@ def tenor(captions: typing.Sequence[str], size: ImageSize):
                                      x=((size.width - toptext.width) / 2),
                                      y=int(size.height * .025))
     if captions[1]:
-        # tecnicamente redundante, mas adiciona fonte twemoji
-        bottomtext = pyvips.Image.text(".", fontfile=twemoji)
         # gerar texto
         bottomtext = pyvips.Image.text(
             f"<span foreground=\"white\">{captions[1]}</span>",
             font=f"Twemoji Color Emoji,Ubuntu {textsize}px",
             rgba=True,
-            fontfile="rendering/fonts/Ubuntu-R.ttf",
             align=pyvips.Align.CENTRE,
             width=int(size.width * .95),
             height=int((size.height * .95) / 3)
@@ -215,20 +198,19 @@ def tenor(captions: typing.Sequence[str], size: ImageSize):
     return outfile
 
 
+@nogil
+@cached_render
 def whisper(captions: typing.Sequence[str], size: ImageSize):
     captions = escape(captions)
     # imagem em branco
     overlay = pyvips.Image.black(size.width, size.height).new_from_image([0, 0, 0, 0]).copy(
         interpretation=pyvips.enums.Interpretation.SRGB)
 
-    # tecnicamente redundante, mas adiciona fonte twemoji
-    text = pyvips.Image.text(".", fontfile=twemoji)
     # gerar texto
     text = pyvips.Image.text(
         f"<span foreground=\"white\">{captions[0]}</span>",
         font=f"Twemoji Color Emoji,Upright {size.width // 6}px",
         rgba=True,
-        fontfile="rendering/fonts/whisper.otf",
         align=pyvips.Align.CENTRE,
         width=int(size.width * .95),
         height=int(size.height * .95)
@@ -241,15 +223,14 @@ def whisper(captions: typing.Sequence[str], size: ImageSize):
     return outfile
 
 
+@nogil
+@cached_render
 def snapchat(captions: typing.Sequence[str], size: ImageSize):
-    # tecnicamente redundante, mas adiciona fonte twemoji
-    text = pyvips.Image.text(".", fontfile=twemoji)
     # gerar texto
     text = pyvips.Image.text(
         f"<span foreground=\"white\">{captions[0]}</span>",
         font=f"Twemoji Color Emoji,Helvetica Neue {size.width // 20}px",
         rgba=True,
-        fontfile="rendering/fonts/HelveticaNeue.otf",
         align=pyvips.Align.CENTRE,
         width=int(size.width * .98),
         height=size.height // 3
@@ -270,18 +251,16 @@ def snapchat(captions: typing.Sequence[str], size: ImageSize):
     return outfile
 
 
+@nogil
 def generic_image_caption(image: str, captions: typing.Sequence[str], size: ImageSize):
     # constantes usadas pelo esmbot
     fontsize = size.width / 10
     textwidth = size.width * (2 / 3) * .92
-    # tecnicamente redundante, mas adiciona fonte twemoji
-    out = pyvips.Image.text(".", fontfile=twemoji)
     # gerar texto
     out = pyvips.Image.text(
         captions[0],
         font=f"Twemoji Color Emoji,Atkinson Hyperlegible Bold {fontsize}px",
         rgba=True,
-        fontfile="rendering/fonts/AtkinsonHyperlegible-Bold.ttf",
         align=pyvips.Align.CENTRE,
         width=textwidth
     )
@@ -309,17 +288,16 @@ def generic_image_caption(image: str, captions: typing.Sequence[str], size: Imag
     return outfile
 
 
+@nogil
+@cached_render
 def twitter_text(captions: typing.Sequence[str], size: ImageSize, dark: bool):
     captions = escape(captions)
     fontsize = size.width / 20
-    # tecnicamente redundante, mas adiciona fonte twemoji
-    out = pyvips.Image.text(".", fontfile=twemoji)
     # gerar texto
     out = pyvips.Image.text(
         f"<span foreground=\"{'white' if dark else 'black'}\">{captions[0]}</span>",
         font=f"Twemoji Color Emoji,TwitterChirp {fontsize}px",
         rgba=True,
-        fontfile="rendering/fonts/chirp-regular-web.woff2",
         align=pyvips.Align.LOW,
         width=size.width
     )
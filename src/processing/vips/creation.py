@@ -2,12 +2,14 @@ import typing
 
 import pyvips
 
-from processing.vips.caption import twemoji
+from processing.common import nogil
 from processing.vips.vipsutils import escape
-from processing.vips.vipsutils import normalize
+from processing.vips.vipsutils import cached_render, normalize
 from utils.tempfiles import reserve_tempfile
 
 
+@nogil
+@cached_render
 def yskysn(captions: typing.Sequence[str]):
     captions = escape(captions)
     # load stuff
@@ -15,8 +17,6 @@ def yskysn(captions: typing.Sequence[str]):
     # here for my sanity, dimensions of text area
     w = 500
     h = 582
-    # technically redundant but adds twemoji font
-    text_prerender = pyvips.Image.text(".", fontfile=twemoji)
     # generate text
     text_prerender, autofit_dict = pyvips.Image.text(
         f"<span foreground='white'>"
@@ -24,7 +24,6 @@ def yskysn(captions: typing.Sequence[str]):
         f"</span>",
         font=f"Twemoji Color Emoji,Tahoma Bold 56",
         rgba=True,
-        fontfile="rendering/fonts/TAHOMABD.TTF",
         align=pyvips.Align.CENTRE,
         width=w,
         height=h,
@@ -34,8 +33,6 @@ def yskysn(captions: typing.Sequence[str]):
     if autofit_dpi <= 72:
         text = text_prerender
     else:
-        # technically redundant but adds twemoji font
-        text = pyvips.Image.text(".", fontfile=twemoji)
         # generate text
         text = pyvips.Image.text(
             f"<span foreground='white'>"
@@ -43,7 +40,6 @@ def yskysn(captions: typing.Sequence[str]):
             f"</span>",
             font=f"Twemoji Color Emoji,Tahoma Bold 56",
             rgba=True,
-            fontfile="rendering/fonts/TAHOMABD.TTF",
             align=pyvips.Align.CENTRE,
             width=w,
             height=h,
@@ -67,6 +63,8 @@ def yskysn(captions: typing.Sequence[str]):
     return outfile
 
 
+@nogil
+@cached_render
 def f1984(captions: typing.Sequence[str]):
     captions = escape(captions)
 
@@ -77,14 +75,11 @@ def f1984(captions: typing.Sequence[str]):
     else:
         im = normalize(pyvips.Image.new_from_file("rendering/images/1984/1984.png"))
 
-    # technically redundant but adds twemoji font
-    speech_bubble = pyvips.Image.text(".", fontfile=twemoji)
     # generate text
     speech_bubble = pyvips.Image.text(
         captions[0],
         font=f"Twemoji Color Emoji,Atkinson Hyperlegible Bold",
         rgba=True,
-        fontfile="rendering/fonts/AtkinsonHyperlegible-Bold.ttf",
         align=pyvips.Align.CENTRE,
         width=290,
         height=90
@@ -95,14 +90,11 @@ def f1984(captions: typing.Sequence[str]):
     im = im.composite2(speech_bubble, pyvips.BlendMode.OVER, x=60, y=20)
 
     if not originaldate:
-        # technically redundant but adds twemoji font
-        date = pyvips.Image.text(".", fontfile=twemoji)
         # generate text
         date = pyvips.Image.text(
             captions[1].upper(),
             font=f"Twemoji Color Emoji,ImpactMix",
             rgba=True,
-            fontfile="rendering/fonts/ImpactMix.ttf",
             align=pyvips.Align.CENTRE,
             width=124,
             height=34
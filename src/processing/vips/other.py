@@ -5,7 +5,7 @@ import pyvips
 
 import processing.ffmpeg
 import processing.ffprobe
-from processing.common import run_parallel, NonBugError
+from processing.common import run_parallel, NonBugError, nogil
 from utils.tempfiles import reserve_tempfile
 import processing.vips.vipsutils
 from processing.vips.vipsutils import normalize
@@ -28,6 +28,7 @@ async def uncaption(file, frame_to_try: int, tolerance: float):
     return await processing.ffmpeg.trim_top(file, cap_height)
 
 
+@nogil
 def jpeg(file, strength, stretch, quality):
     im = normalize(pyvips.Image.new_from_file(file))
     orig_w = im.width
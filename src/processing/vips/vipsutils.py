@@ -1,14 +1,51 @@
 import dataclasses
+import functools
+import hashlib
 import html
+import threading
 import typing
 
 import pyvips
 
+import config
 import processing.ffmpeg
 import processing.ffprobe
-from processing.common import run_parallel
+from processing.common import run_parallel, nogil
+from utils.diskcache import DiskCache
 from utils.tempfiles import reserve_tempfile
 
+# legendas renderizadas, a mesma legenda na mesma largura é pedida de novo o tempo todo
+render_cache = DiskCache("mediaforge-renders",
+                         config.render_cache_size if hasattr(config, "render_cache_size") else 100_000_000)
+# funções @nogil rodam em várias threads ao mesmo tempo
+render_cache_lock = threading.Lock()
+
+
+def cached_render(func: typing.Callable):
+    """
+    guarda o png gerado por uma função de renderização de texto, com chave (função, legendas, ImageSize, args).
+    só serve para funções cuja saída depende apenas dos argumentos (sem arquivos de entrada). fora do processo do bot
+    (nos workers do pool de processos) só chama a função: lá o índice estaria vazio e os arquivos escritos passariam
+    do limite sem que o processo do bot soubesse deles
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not render_cache.ready:
+            return func(*args, **kwargs)
+        key = hashlib.blake2b(repr((func.__module__, func.__qualname__, args, sorted(kwargs.items()))).encode(),
+                              digest_size=16).hexdigest()
+        with render_cache_lock:
+            cached = render_cache.get(key)
+        if cached:
+            return cached
+        out = func(*args, **kwargs)
+        with render_cache_lock:
+            render_cache.put(key, out)
+        return out
+
+    return wrapper
+
 
 @dataclasses.dataclass
 class ImageSize:
@@ -61,6 +98,7 @@ def overlay_in_middle(background: pyvips.Image, foreground: pyvips.Image) -> pyv
                                  y=((background.height - foreground.height) // 2))
 
 
+@nogil
 def naive_stack(file0, file1):
     # load files
     im0 = normalize(pyvips.Image.new_from_file(file0))
@@ -74,6 +112,7 @@ def naive_stack(file0, file1):
     return outfile
 
 
+@nogil
 def stack(file0, file1, style):
     # load files
     im0 = normalize(pyvips.Image.new_from_file(file0))
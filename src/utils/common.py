@@ -1,3 +1,4 @@
+import contextlib
 import datetime
 import typing
 
@@ -11,8 +12,56 @@ import config
 from core import database
 
 
+# sessão http compartilhada durante a vida do bot, criada em MyBot.setup_hook()
+http_session: aiohttp.ClientSession | None = None
+# estatísticas de reutilização de conexão da sessão compartilhada
+http_stats = {"requests": 0, "new_connections": 0, "reused_connections": 0, "dns_cache_hits": 0,
+              "dns_cache_misses": 0}
+
+
+def count_event(stat: str):
+    async def handler(*_):
+        http_stats[stat] += 1
+
+    return handler
+
+
+async def init_http_session():
+    global http_session
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(count_event("requests"))
+    trace.on_connection_create_end.append(count_event("new_connections"))
+    trace.on_connection_reuseconn.append(count_event("reused_connections"))
+    trace.on_dns_cache_hit.append(count_event("dns_cache_hits"))
+    trace.on_dns_cache_miss.append(count_event("dns_cache_misses"))
+    # quase todo o tráfego vai para os mesmos poucos hosts (cdn.discordapp.com, media.tenor.com, tenor.googleapis.com)
+    # então vale manter as conexões e o dns em cache
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=300, keepalive_timeout=60)
+    http_session = aiohttp.ClientSession(connector=connector, headers={'Connection': 'keep-alive'},
+                                         trace_configs=[trace])
+
+
+async def close_http_session():
+    global http_session
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+
+
+@contextlib.asynccontextmanager
+async def get_http_session():
+    """
+    a sessão compartilhada se existir, senão (ex: processo do heartbeat) uma sessão temporária
+    """
+    if http_session is not None and not http_session.closed:
+        yield http_session
+    else:
+        async with aiohttp.ClientSession(headers={'Connection': 'keep-alive'}) as session:
+            yield session
+
+
 async def fetch(url):
-    async with aiohttp.ClientSession(headers={'Connection': 'keep-alive'}) as session:
+    async with get_http_session() as session:
         async with session.get(url) as response:
             if response.status != 200:
                 response.raise_for_status()
@@ -0,0 +1,127 @@
+"""
+cache de arquivos em disco com limite de bytes e despejo LRU, usado pelos caches de resultados e downloads
+"""
+import collections
+import os
+import shutil
+
+import utils.tempfiles
+from core.clogs import logger
+from utils.tempfiles import reserve_tempfile
+
+
+def link_or_copy(src: str, dst: str):
+    # hardlinks são gratuitos no mesmo sistema de arquivos (/dev/shm normalmente), copiar é o plano b
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def extension(file: str) -> str | None:
+    base = os.path.basename(file)
+    return base.split(".")[-1] if "." in base else None
+
+
+class DiskCache:
+    def __init__(self, name: str, max_bytes: int):
+        """
+        :param name: nome do diretório, criado ao lado de utils.tempfiles.temp_dir (que é apagado a cada inicialização)
+        :param max_bytes: limite de tamanho em bytes. 0 ou None desativa o cache
+        """
+        self.directory = os.path.join(os.path.dirname(utils.tempfiles.temp_dir), name)
+        self.max_bytes = max_bytes or 0
+        # chave -> (caminho, tamanho), do menos para o mais usado recentemente
+        self.index: collections.OrderedDict[str, tuple[str, int]] = collections.OrderedDict()
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0}
+        # só o processo que chamou init() tem o índice. processos do pool (spawn) começam com um vazio
+        self.ready = False
+
+    def init(self):
+        """
+        cria o diretório e reconstrói o índice LRU a partir do mtime dos arquivos
+        """
+        if not self.max_bytes:
+            logger.debug(f"cache {self.directory} desativado")
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith("."):  # restos de uma escrita interrompida
+                os.remove(path)
+                continue
+            st = os.stat(path)
+            entries.append((st.st_mtime, name.split(".")[0], path, st.st_size))
+        for _, key, path, size in sorted(entries):
+            self.index[key] = (path, size)
+            self.total_bytes += size
+        self.evict()
+        self.ready = True
+        logger.debug(f"cache {self.directory} com {len(self.index)} arquivos")
+
+    def __contains__(self, key: str):
+        return key in self.index
+
+    def size(self, key: str) -> int | None:
+        return self.index[key][1] if key in self.index else None
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and self.index:
+            self.discard(next(iter(self.index)))
+
+    def discard(self, key: str):
+        path, size = self.index.pop(key)
+        self.total_bytes -= size
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> str | None:
+        """
+        procura um arquivo no cache
+        :param key: chave
+        :return: arquivo temporário da TempFileSession atual com o conteúdo, ou None se não estiver no cache
+        """
+        if key not in self.index:
+            self.stats["misses"] += 1
+            return None
+        path, _ = self.index[key]
+        # link para a TempFileSession atual, já que ela apaga seus arquivos ao sair
+        out = utils.tempfiles.temp_file_name(extension(path))
+        try:
+            link_or_copy(path, out)
+            os.utime(path)
+        except FileNotFoundError:
+            self.discard(key)
+            self.stats["misses"] += 1
+            return None
+        reserve_tempfile(out)
+        self.index.move_to_end(key)
+        self.stats["hits"] += 1
+        logger.debug(f"{key} encontrado no cache {self.directory}")
+        return out
+
+    def put(self, key: str, file: str):
+        """
+        guarda um arquivo no cache, removendo os menos usados recentemente se passar do limite
+        :param key: chave, deve ser seguro como nome de arquivo
+        :param file: arquivo para guardar
+        """
+        if not self.max_bytes:
+            return
+        if key in self.index:
+            self.discard(key)
+        size = os.path.getsize(file)
+        if size > self.max_bytes:
+            return
+        ext = extension(file)
+        path = os.path.join(self.directory, f"{key}.{ext}" if ext else key)
+        tmp = os.path.join(self.directory, f".{key}")
+        link_or_copy(file, tmp)
+        os.replace(tmp, path)
+        self.index[key] = (path, size)
+        self.total_bytes += size
+        self.evict()
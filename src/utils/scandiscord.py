@@ -2,7 +2,11 @@
 Funções auxiliares diversas para comandos
 """
 
+import asyncio
+import collections
 import json
+import time
+import typing
 
 import discord
 import regex as re
@@ -14,6 +18,168 @@ from utils.common import fetch
 from utils.web import contentlength
 
 tenor_url_regex = re.compile(r"https?://tenor\.com/view/([\w\d]+-)*(\d+)/?")
+# quantas mensagens antes do comando são procuradas, igual ao limite do histórico
+search_depth = 50
+# mensagens lembradas por canal, com folga para comandos que chegam depois de outras mensagens
+max_tracked = search_depth * 4
+# idade máxima de uma mensagem no índice. as urls de anexos do discord são assinadas e expiram depois de ~24h, então
+# mensagens mais velhas que isto fazem a busca voltar para o history(), que devolve urls novas
+max_age = 60 * 60 * 6
+# pode apontar para um servidor local que imita a API do tenor
+tenor_api = config.tenor_api_url if hasattr(config, "tenor_api_url") else "https://tenor.googleapis.com/v2"
+# a API aceita até 50 IDs por chamada de posts
+tenor_batch_size = 50
+tenor_ttl = 60 * 60
+tenor_cache_size = 4096
+# ID do post -> (time.monotonic(), media_formats)
+tenor_cache: collections.OrderedDict[str, tuple[float, dict]] = collections.OrderedDict()
+
+
+class TenorError(Exception):
+    """resposta de erro da API do tenor"""
+    pass
+
+
+async def tenor_media(ids: typing.Sequence[str]) -> dict[str, dict]:
+    """
+    resolve IDs de posts do tenor em seus media_formats, usando o cache e uma chamada da API para todos os que faltam
+    :param ids: IDs de posts do tenor
+    :return: dict de ID -> media_formats. IDs que o tenor não conhece ficam de fora
+    """
+    now = time.monotonic()
+    out = {}
+    missing = []
+    for gif_id in dict.fromkeys(ids):
+        if gif_id in tenor_cache and now - tenor_cache[gif_id][0] < tenor_ttl:
+            tenor_cache.move_to_end(gif_id)
+            out[gif_id] = tenor_cache[gif_id][1]
+        else:
+            missing.append(gif_id)
+    for i in range(0, len(missing), tenor_batch_size):
+        batch = missing[i:i + tenor_batch_size]
+        tenor = json.loads(await fetch(f"{tenor_api}/posts?ids={','.join(batch)}&key={config.tenor_key}"
+                                       f"&limit={len(batch)}"))
+        if 'error' in tenor:
+            raise TenorError(tenor['error'])
+        for result in tenor['results']:
+            out[result['id']] = result['media_formats']
+            tenor_cache[result['id']] = (now, result['media_formats'])
+            tenor_cache.move_to_end(result['id'])
+    while len(tenor_cache) > tenor_cache_size:
+        tenor_cache.popitem(last=False)
+    return out
+
+
+def tenor_id(url: str) -> str | None:
+    if (match := tenor_url_regex.fullmatch(url)) is not None:
+        return match.group(2)
+    return None
+
+
+class ChannelMedia:
+    """
+    mensagens recentes com mídia em um canal, alimentado pelos eventos de mensagem em BotEventsCog
+    """
+
+    def __init__(self):
+        # ids de todas as mensagens recentes que não foram apagadas, na ordem de chegada
+        self.recent: collections.OrderedDict[int, None] = collections.OrderedDict()
+        # id da mensagem -> [time.monotonic() de quando chegou, mensagem, urls de handlemessagesave() ou None]
+        self.messages: collections.OrderedDict[int, list] = collections.OrderedDict()
+
+    def add(self, m: discord.Message):
+        if m.id in self.recent:
+            return
+        self.recent[m.id] = None
+        while len(self.recent) > max_tracked:
+            old, _ = self.recent.popitem(last=False)
+            self.messages.pop(old, None)
+        if might_have_media(m):
+            self.messages[m.id] = [time.monotonic(), m, None]
+
+    def edit(self, m: discord.Message):
+        # embeds geralmente chegam em uma edição depois da mensagem, com urls novas
+        if m.id in self.messages:
+            self.messages[m.id] = [time.monotonic(), m, None]
+
+    def delete(self, message_id: int):
+        self.recent.pop(message_id, None)
+        self.messages.pop(message_id, None)
+
+    def window(self, m: discord.Message) -> list[int] | None:
+        """
+        ids das search_depth mensagens antes de m, as mesmas de history(limit=search_depth, before=m), ou None se o
+        índice não consegue provar que tem todas elas com urls ainda válidas
+        """
+        # ids do discord crescem com o tempo, então m não precisa estar no índice
+        ids = [i for i in self.recent if i < m.id][-search_depth:]
+        if len(ids) < search_depth:
+            # o índice começou depois do início da janela (ou o canal tem menos mensagens)
+            return None
+        now = time.monotonic()
+        if any(now - self.messages[i][0] > max_age for i in ids if i in self.messages):
+            return None
+        return ids
+
+    def covers(self, m: discord.Message):
+        """se o índice tem toda a janela de busca antes de m"""
+        return self.window(m) is not None
+
+    def before(self, m: discord.Message):
+        """entradas com mídia dentro da janela antes de m, da mais nova para a mais antiga"""
+        if (ids := self.window(m)) is None:
+            return
+        for i in reversed(ids):
+            if i in self.messages:
+                yield self.messages[i]
+
+    async def urls(self, entry: list):
+        if entry[2] is None:
+            entry[2] = await handlemessagesave(entry[1])
+        return entry[2]
+
+
+class RecentMedia:
+    """
+    índice limitado de ChannelMedia por canal, os canais usados menos recentemente são descartados
+    """
+
+    def __init__(self, max_channels=1000):
+        self.max_channels = max_channels
+        self.channels: collections.OrderedDict[int, ChannelMedia] = collections.OrderedDict()
+
+    def get(self, channel_id: int) -> ChannelMedia | None:
+        if channel_id in self.channels:
+            self.channels.move_to_end(channel_id)
+        return self.channels.get(channel_id)
+
+    def add(self, m: discord.Message):
+        if m.channel.id not in self.channels:
+            self.channels[m.channel.id] = ChannelMedia()
+            while len(self.channels) > self.max_channels:
+                self.channels.popitem(last=False)
+        self.get(m.channel.id).add(m)
+
+    def edit(self, m: discord.Message):
+        if m.channel.id in self.channels:
+            self.channels[m.channel.id].edit(m)
+
+    def delete(self, channel_id: int, message_id: int):
+        if channel_id in self.channels:
+            self.channels[channel_id].delete(message_id)
+
+    def clear(self):
+        # mensagens enviadas enquanto desconectado nunca chegam, então o índice não está mais completo
+        self.channels.clear()
+
+
+recent_media = RecentMedia()
+
+
+def might_have_media(m: discord.Message):
+    # links podem virar embeds depois, em uma edição
+    return bool(m.attachments or m.embeds or m.stickers or "http" in m.content or
+                m.type == discord.MessageType.thread_starter_message)
 
 
 async def handlemessagesave(m: discord.Message):
@@ -27,18 +193,22 @@ async def handlemessagesave(m: discord.Message):
         m = m.reference.resolved
     detectedfiles = []
     if len(m.embeds):
-        for embed in m.embeds:
+        # https://github.com/esmBot/esmBot/blob/master/utils/imagedetect.js#L34
+        # todos os gifs do tenor na mensagem são resolvidos em uma só chamada
+        tenor_ids = [tenor_id(embed.url) for embed in m.embeds if embed.type == "gifv" and embed.url]
+        tenor = await tenor_media([i for i in tenor_ids if i]) if any(tenor_ids) else {}
+
+        async def embedfile(embed: discord.Embed):
             if embed.type == "gifv":
-                # https://github.com/esmBot/esmBot/blob/master/utils/imagedetect.js#L34
-                if (match := tenor_url_regex.fullmatch(embed.url)) is not None:
-                    gif_id = match.group(2)
-                    tenor = await fetch(
-                        f"https://tenor.googleapis.com/v2/posts?ids={gif_id}&key={config.tenor_key}&limit=1")
-                    tenor = json.loads(tenor)
-                    detectedfiles.append(tenor['results'][0]['media_formats']['gif']['url'])
+                if (gif_id := tenor_id(embed.url)) in tenor:
+                    return tenor[gif_id]['gif']['url']
             elif embed.type in ["image", "video", "audio"]:
                 if await contentlength(embed.url):  # prevent adding youtube videos and such
-                    detectedfiles.append(embed.url)
+                    return embed.url
+            return None
+
+        # checa todas as embeds ao mesmo tempo, mantendo a ordem
+        detectedfiles += [f for f in await asyncio.gather(*[embedfile(embed) for embed in m.embeds]) if f]
     if len(m.attachments):
         for att in m.attachments:
             if not att.filename.endswith("txt"):  # it was reading traceback attachments >:(
@@ -79,7 +249,19 @@ async def imagesearch(ctx, nargs=1):
         outfiles += hm
         if len(outfiles) >= nargs:
             return outfiles[:nargs]
-    async for m in ctx.channel.history(limit=50, before=ctx.message):
+    # respond from the index of recent media first, without hitting the REST API
+    index = recent_media.get(ctx.channel.id)
+    if index is not None and index.covers(ctx.message):
+        for entry in list(index.before(ctx.message)):
+            m = entry[1]
+            if m not in messageschecked:
+                messageschecked.append(m)
+                outfiles += await index.urls(entry)
+                if len(outfiles) >= nargs:
+                    return outfiles[:nargs]
+        # a janela inteira já foi vista
+        return False
+    async for m in ctx.channel.history(limit=search_depth, before=ctx.message):
         logger.debug(m.type)
         if m not in messageschecked:
             messageschecked.append(m)
@@ -101,18 +283,19 @@ async def handletenor(m: discord.Message, ctx: commands.Context, gif=False):
     if len(m.embeds):
         if m.embeds[0].type == "gifv":
             # https://github.com/esmBot/esmBot/blob/master/utils/imagedetect.js#L34
-            tenor = await fetch(
-                f"https://tenor.googleapis.com/v2/posts?ids={m.embeds[0].url.split('-').pop()}&key={config.tenor_key}")
-            tenor = json.loads(tenor)
-            if 'error' in tenor:
-                logger.error(tenor['error'])
-                await ctx.send(f"{config.emojis['2exclamation']} Tenor Error! `{tenor['error']}`")
+            gif_id = tenor_id(m.embeds[0].url) or m.embeds[0].url.split('-').pop()
+            try:
+                tenor = await tenor_media([gif_id])
+            except TenorError as e:
+                logger.error(e)
+                await ctx.send(f"{config.emojis['2exclamation']} Tenor Error! `{e}`")
                 return False
+            if gif_id not in tenor:
+                return None
+            if gif:
+                return tenor[gif_id]['gif']['url']
             else:
-                if gif:
-                    return tenor['results'][0]['media_formats']['gif']['url']
-                else:
-                    return tenor['results'][0]['media_formats']['mp4']['url']
+                return tenor[gif_id]['mp4']['url']
     return None
 
 
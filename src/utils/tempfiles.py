@@ -74,6 +74,7 @@ class TempFileSession:
             pass
         logger.debug("Nova TempFileSession criada")
         session.set([])
+        probes.set({})
 
     async def __aexit__(self, *_):
         files = session.get()
@@ -82,7 +83,10 @@ class TempFileSession:
         for f in fls:
             if isinstance(f, Exception):
                 logger.warn(f)
+        probes.get().clear()
         logger.debug(f"TempFileSession encerrado!")
 
 
 session: contextvars.ContextVar[list[str]] = contextvars.ContextVar("session")
+# resultados de processing.ffprobe.probe() memorizados durante a TempFileSession
+probes: contextvars.ContextVar[dict] = contextvars.ContextVar("probes")
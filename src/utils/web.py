@@ -1,3 +1,9 @@
+import asyncio
+import hashlib
+import os
+import time
+import urllib.parse
+
 import aiofiles
 import aiohttp
 import humanize
@@ -5,9 +11,117 @@ import humanize
 import config
 import processing.ffmpeg
 import processing.common
+import utils.tempfiles
 from core.clogs import logger
+from utils.common import get_http_session
+from utils.diskcache import DiskCache
 from utils.tempfiles import reserve_tempfile
 
+# downloads recentes, para que comandos encadeados no mesmo anexo não precisem baixá-lo de novo
+downloads = DiskCache("mediaforge-downloads",
+                      config.download_cache_size if hasattr(config, "download_cache_size") else 250_000_000)
+# chave -> (ETag, Last-Modified) da resposta que foi guardada
+download_validators: dict[str, tuple[str | None, str | None]] = {}
+# parâmetros de assinatura do CDN do discord, mudam a cada vez que o link é gerado mas não o arquivo
+discord_signed_params = {"ex", "is", "hm"}
+discord_cdn_hosts = {"cdn.discordapp.com", "media.discordapp.net"}
+download_chunk_size = 256 * 1024
+# downloads simultâneos por host em saveurls()
+max_downloads_per_host = 4
+host_semaphores: dict[str, asyncio.Semaphore] = {}
+# url -> (time.monotonic(), tamanho) de contentlength()
+contentlength_memo: dict[str, tuple[float, int | bool]] = {}
+contentlength_ttl = 60
+
+
+def normalize_url(url: str) -> str:
+    """
+    remove partes de uma url que não mudam o arquivo (assinaturas do discord, fragmentos)
+    :param url: url
+    :return: url normalizada
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+    if parts.hostname in discord_cdn_hosts:
+        query = [(k, v) for k, v in query if k not in discord_signed_params]
+    return urllib.parse.urlunsplit((parts.scheme, parts.netloc.lower(), parts.path,
+                                    urllib.parse.urlencode(sorted(query)), ""))
+
+
+def too_big(size: int, partial=False):
+    return processing.common.NonBugError(f"Your file is too big ({'mais de ' if partial else ''}"
+                                         f"{humanize.naturalsize(size)}). "
+                                         f"Estou configurado para baixar apenas arquivos até "
+                                         f"{humanize.naturalsize(config.max_file_size)}.")
+
+
+def download_key(url: str) -> str:
+    return hashlib.blake2b(normalize_url(url).encode(), digest_size=16).hexdigest()
+
+
+def same_file(key: str, url: str, resp: aiohttp.ClientResponse, size: int | None) -> bool:
+    """
+    se a resposta de revalidação descreve o mesmo arquivo guardado em downloads
+    :param size: tamanho total do arquivo remoto, do Content-Range ou Content-Length
+    """
+    if size != downloads.size(key):
+        return False
+    etag, modified = download_validators.get(key, (None, None))
+    if etag or resp.headers.get("ETag"):
+        return etag == resp.headers.get("ETag")
+    if urllib.parse.urlsplit(url).hostname in discord_cdn_hosts:
+        # anexos do discord nunca mudam no mesmo caminho, o tamanho só protege contra respostas estranhas
+        return True
+    return modified is not None and modified == resp.headers.get("Last-Modified")
+
+
+async def download_body(resp: aiohttp.ClientResponse, key: str, extension: str | None) -> str:
+    # size of file to download, chunked transfer encoding may not have one
+    if "Content-Length" in resp.headers:
+        size = int(resp.headers["Content-Length"])
+        logger.info(f"url é {humanize.naturalsize(size)}")
+        if config.max_file_size < size:  # file size to download must be under max configured size.
+            raise too_big(size)
+    logger.info(f"URL de salvamento {resp.url}")
+    name = reserve_tempfile(extension)
+    # escreve pedaços direto no arquivo em vez de ler tudo para a memória
+    downloaded = 0
+    async with aiofiles.open(name, mode='wb') as f:
+        async for chunk in resp.content.iter_chunked(download_chunk_size):
+            downloaded += len(chunk)
+            if config.max_file_size < downloaded:  # o servidor mentiu ou não disse o tamanho
+                raise too_big(downloaded, partial=True)
+            await f.write(chunk)
+    downloads.put(key, name)
+    download_validators[key] = (resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+    return name
+
+
+async def revalidate(session: aiohttp.ClientSession, url: str, key: str, extension: str | None) -> str | None:
+    """
+    confere se o arquivo em downloads ainda é o mesmo pedindo só o primeiro byte
+    :return: o arquivo (do cache, ou baixado se o servidor ignorou o Range), ou None se mudou
+    """
+    etag, _ = download_validators.get(key, (None, None))
+    headers = {"Range": "bytes=0-0"}
+    if etag:
+        headers["If-None-Match"] = etag
+    async with session.get(url, headers=headers) as resp:
+        if resp.status == 304:
+            return downloads.get(key)
+        if resp.status == 206:
+            # um byte, lido para que a conexão volte para o pool
+            await resp.read()
+            total = resp.headers.get("Content-Range", "").split("/")[-1]
+            if total.isdigit() and same_file(key, url, resp, int(total)):
+                return downloads.get(key)
+            return None
+        if resp.status == 200:
+            # servidor ignorou o Range e já está mandando o arquivo inteiro, então aproveita
+            return await download_body(resp, key, extension)
+        await resp.read()
+        return None
+
 
 async def saveurl(url: str) -> str:
     """
@@ -25,53 +139,107 @@ async def saveurl(url: str) -> str:
         if "." in after_slash:
             extension = after_slash.split(".")[-1]
         # extension will stay None if no extension detected.
-    name = reserve_tempfile(extension)
+    key = download_key(url)
+    name = None
 
     # https://github.com/aio-libs/aiohttp/issues/3904#issuecomment-632661245
-    async with aiohttp.ClientSession(headers={'Connection': 'keep-alive'}) as session:
-        # i used to make a head request to check size first, but for some reason head requests can be super slow
-        async with session.get(url) as resp:
-            if resp.status == 200:
-                if "Content-Length" not in resp.headers:  # size of file to download
-                    raise Exception("Não é possível determinar o tamanho do arquivo!")
-                size = int(resp.headers["Content-Length"])
-                logger.info(f"url é {humanize.naturalsize(size)}")
-                if config.max_file_size < size:  # file size to download must be under max configured size.
-                    raise processing.common.NonBugError(f"Your file is too big ({humanize.naturalsize(size)}). "
-                                                        f"Estou configurado para baixar apenas arquivos até "
-                                                        f"{humanize.naturalsize(config.max_file_size)}.")
-                logger.info(f"URL de salvamento {url}")
-                async with aiofiles.open(name, mode='wb') as f:
-                    await f.write(await resp.read())
-            else:
-                logger.error(f"aiohttp status {resp.status}")
-                logger.error(f"aiohttp status {await resp.read()}")
-                resp.raise_for_status()
+    async with get_http_session() as session:
+        if key in downloads:
+            name = await revalidate(session, url, key, extension)
+            if name:
+                logger.info(f"URL {url} encontrada no cache de downloads")
+        if not name:
+            # i used to make a head request to check size first, but for some reason head requests can be super slow
+            async with session.get(url) as resp:
+                if resp.status == 200:
+                    name = await download_body(resp, key, extension)
+                else:
+                    logger.error(f"aiohttp status {resp.status}")
+                    logger.error(f"aiohttp status {await resp.read()}")
+                    resp.raise_for_status()
     if tenorgif and name:
         name = await processing.ffmpeg.mp4togif(name)
     return name
 
 
+async def saveurl_limited(url: str) -> str:
+    host = urllib.parse.urlsplit(url).hostname
+    if host not in host_semaphores:
+        host_semaphores[host] = asyncio.Semaphore(max_downloads_per_host)
+    async with host_semaphores[host]:
+        return await saveurl(url)
+
+
 async def saveurls(urls: list):
     """
-    salva a lista de URLs e a retorna
+    salva a lista de URLs ao mesmo tempo e a retorna na mesma ordem
     :param urls: lista de URLs
     :return: lista de arquivos
     """
     if not urls:
         return False
-    files = []
-    for url in urls:
-        files.append(await saveurl(url))
-    return files
+    tfs = utils.tempfiles.session.get()
+    reserved_before = len(tfs)
+    tasks = [asyncio.create_task(saveurl_limited(url)) for url in urls]
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        # se um falhar, os outros não servem para nada
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # arquivos reservados pelos downloads cancelados podem ser apagados agora em vez de no fim da sessão
+        partial = tfs[reserved_before:]
+        del tfs[reserved_before:]
+        for file in partial:
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+        raise
 
 
-async def contentlength(url):
-    async with aiohttp.ClientSession(headers={'Connection': 'keep-alive'}) as session:
+async def remotesize(url):
+    async with get_http_session() as session:
         # i used to make a head request to check size first, but for some reason head requests can be super slow
-        async with session.get(url) as resp:
-            if resp.status == 200:
-                if "Content-Length" not in resp.headers:  # size of file to download
-                    return False
-                else:
+        # so ask for a single byte instead, the server tells us the full size in Content-Range
+        try:
+            async with session.get(url, headers={"Range": "bytes=0-0"}) as resp:
+                if resp.status == 206 and "/" in resp.headers.get("Content-Range", ""):
+                    total = resp.headers["Content-Range"].split("/")[-1]
+                    if total.isdigit():
+                        return int(total)
+                # servidor ignorou o Range, não lê o corpo
+                if resp.status == 200 and "Content-Length" in resp.headers:
                     return int(resp.headers["Content-Length"])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.debug(f"range request para {url} falhou: {e!r}")
+        try:
+            async with session.head(url, allow_redirects=True) as resp:
+                if resp.status == 200 and "Content-Length" in resp.headers:
+                    return int(resp.headers["Content-Length"])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # sem tamanho, quem chamou trata como desconhecido
+            logger.debug(f"head request para {url} falhou: {e!r}")
+    return False
+
+
+async def contentlength(url):
+    """
+    tamanho de um arquivo remoto sem baixá-lo. memorizado por alguns segundos para que escanear a mesma mensagem de
+    novo seja gratuito
+    :param url: url
+    :return: tamanho em bytes, ou False se o servidor não informar
+    """
+    now = time.monotonic()
+    if url in contentlength_memo and now - contentlength_memo[url][0] < contentlength_ttl:
+        return contentlength_memo[url][1]
+    size = await remotesize(url)
+    if len(contentlength_memo) >= 1024:
+        # remove entradas vencidas, e se ainda estiver cheio, as mais antigas
+        for k in [k for k, (t, _) in contentlength_memo.items() if now - t >= contentlength_ttl]:
+            del contentlength_memo[k]
+        while len(contentlength_memo) >= 1024:
+            del contentlength_memo[next(iter(contentlength_memo))]
+    contentlength_memo[url] = (now, size)
+    return size